@@ -1,20 +1,30 @@
 import os
+import re
 import sys
 from pathlib import Path
-from svglib.svglib import svg2rlg
-import svglib as svglib
-from reportlab.graphics import renderPDF
 import logging
 import math
-import svg_stack as ss
-from tqdm import tqdm
+import bisect
+import copy
+import functools
+import hashlib
+import io
+import json
+import time
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque, Counter, OrderedDict
+import itertools
 from datetime import datetime
-from boardgamegeek import BGGClient
-import boardgamegeek as bggm
 import xml.etree.ElementTree as xmlET
-from PIL import ImageFont
-from pypdf import PdfMerger
 import platformdirs
+from fetcher import FetchScheduler
+from tracing import Tracer
+from journal import RunJournal, atomic_write
+from records import (LabelRecord, COLOR_GREEN, COLOR_YELLOW, COLOR_ORANGE, COLOR_RED,
+                     NOT_RECOMMENDED_TRESHOLD)
+# svglib, reportlab, pypdf, tqdm, PIL and boardgamegeek are slow to import
+# and only imported where they are used, so that e.g. `main.py --help` starts quickly
 
 APPNAME = 'BGGLabeler'
 
@@ -26,149 +36,172 @@ logging.getLogger("boardgamegeek.api").setLevel(logging.INFO)
 USERNAME="ColbyBoardgames"
 TEST_ID = 285967
 
-COLOR_GREEN = '#008000'
-COLOR_YELLOW = '#ca9a08'
-COLOR_ORANGE = '#e27a07'
-COLOR_RED = '#bb0707'
-
-NOT_RECOMMENDED_TRESHOLD = 0.7
 
 def directories():
+    """
+    Returns the paths of the directories the labeler uses. They are created when
+    first needed (see Context), not here.
+    """
     builddir = Path(platformdirs.user_runtime_dir(APPNAME))
     cachedir = Path(platformdirs.user_cache_dir(APPNAME))
     appdir = Path(getattr(sys, '_MEIPASS', os.getcwd()))
     resdir = appdir / 'res'
-    for d in (builddir, cachedir, appdir, resdir):
-        if not os.path.isdir(d):
-            os.makedirs(d)
     return builddir, cachedir, resdir, appdir
 
 BUILDDIR, CACHEDIR, RESDIR, APPDIR = directories()
-bgg = BGGClient(cache=bggm.CacheBackendSqlite(path=CACHEDIR / "cache.db", ttl=3600))
 # APPDIR relates to the package's internal (virtual) app structure.
 # RESDIR (child of APPDIR) includes files necessary for running the program, such as fonts
 # and the default SVG template
 # It never needs to be accessed by the user
 SVG_TEMPLATE = RESDIR / "label_template.svg"
+# Rendered labels, named after a hash of their content (see label_key)
+LABELDIR = CACHEDIR / "labels"
+# Bump when a change to the code changes how labels look, to invalidate cached labels
+LABEL_CACHE_VERSION = 2
+LABEL_CACHE_SIZE = 256 # MB
+# How long BGG data is cached. Collections change whenever a game is added; game
+# details (names, player counts, categories) almost never; ranks, weights and polls
+# slowly, so games older than GAME_STATS_TTL are used but fetched again in the background.
+COLLECTION_TTL = 3600 # s
+GAME_DETAILS_TTL = 30 * 24 * 3600 # s
+GAME_STATS_TTL = 24 * 3600 # s
+GAME_CACHE_SIZE = 512 # MB
+# Pages drawn between two checkpoints of the PDF in the run journal. Segments are drawn
+# in parallel, so this is also how many pages a process draws at a time
+JOURNAL_SEGMENT_PAGES = 20
+# Games that can fail before any label is made, before a run gives up
+QUARANTINE_LIMIT = 5
 
-def game_info(game):
+class Context:
     """
-    Returns a SimpleNamespace (dot-accessible "dict" object) with game information.
-    """
-    res = {}
-    data = game.data()
-    res['name'] = game.name
-    res['id'] = game.id
-    res['year'] = game.year
-    weight = game.rating_average_weight
-    res['weight'] = weight
-    weight_label = ''
-    weight_color = ''
-    if weight <= 2:
-        weight_label = 'Very Light'
-        weight_color = COLOR_GREEN
-    elif 2 < weight <= 2.8:
-        weight_label = 'Light'
-        weight_color = COLOR_GREEN
-    elif 2.8 < weight <= 3.2:
-        weight_label = 'Medium-Light'
-        weight_color = COLOR_YELLOW
-    elif 3.2 < weight <= 3.7:
-        weight_label = 'Medium'
-        weight_color = COLOR_ORANGE
-    elif 3.7 < weight <= 4:
-        weight_label = 'Medium-Heavy'
-        weight_color = COLOR_ORANGE
-    elif weight > 4:
-        weight_label = 'Heavy'
-        weight_color = COLOR_RED
-    res['weight_label'] = f'{weight_label} ({game.rating_average_weight:.1f})'
-    res['weight_color'] = weight_color
-    minplayers = data['minplayers']
-    maxplayers = data['maxplayers']
-    if minplayers == maxplayers:
-        player_range = minplayers
-    else:
-        player_range = f"{minplayers} - {maxplayers}"
-    res['player_range'] = player_range
-    mintime = game.min_playing_time
-    maxtime = game.max_playing_time
-    if mintime == maxtime:
-        time_range = f"{mintime} min"
-    else:
-        time_range = f"{mintime} - {maxtime} min"
-    res['time_range'] = time_range
-
-
-    res['playing_time_range'] = f"{game.min_playing_time} - {game.max_playing_time} min"
-    res['rating'] = data['stats']['average']
-    best_rank = math.inf
-    best_rank_name = ""
-    for rankinfo in game.ranks:
-        if rankinfo.value is not None and rankinfo.value < best_rank:
-            best_rank = rankinfo.value
-            best_rank_name = rankinfo.name
-    rank_cutoffs = (1, 5, 10, 20, 50, 100, 200, 1000, math.inf)
-    rank_class = min([r for r in rank_cutoffs if best_rank <= r])
-    best_rank_name = best_rank_name.replace('games','').replace('boardgame','all time')
-    if rank_class != math.inf:
-        res['award'] = f"Top {rank_class} {best_rank_name}"
-    res['rank'] = game.bgg_rank
-    res['tags'] = game.categories
-
-    not_recommended = []
-    for ps in game.player_suggestions:
-        d = ps.data()
-        n = ps.numeric_player_count
-        total = d['best'] + d['recommended'] + d['not_recommended']
-        really_not_rec = NOT_RECOMMENDED_TRESHOLD < d['not_recommended'] / total
-        within_count = game.min_players <= n <= game.max_players
-        if really_not_rec and within_count:
-            not_recommended.append(n)
-
-    res['not_recommended'] = not_recommended
-    if not_recommended:
-        not_recommended.sort()
-        not_recommended_ranges = [(not_recommended.pop(0),)]
-        for n in not_recommended:
-            last_range = not_recommended_ranges[-1]
-            if n == 1 + last_range[-1]:
-                not_recommended_ranges[-1] = (last_range[0], n)
-            else:
-                not_recommended_ranges.append((n,))
-        not_recommended_str = ''
-        for i, r in enumerate(not_recommended_ranges):
-            if len(r) == 1:
-                not_recommended_str += f'{r[0]}'
-            else:
-                not_recommended_str += f'{r[0]}-{r[1]}'
-            if i < len(not_recommended_ranges) - 1:
-                not_recommended_str += ','
-        res['not_recommended_str'] = not_recommended_str
+    The parts of the labeler that are expensive to set up (the BGG client with its
+    sqlite cache, the game cache, the snapshot store, the measuring font), each created
+    on first use. `context` is the
+    module's instance; its attributes can be replaced, e.g. with a fake BGG client.
+    """
+    @functools.cached_property
+    def bgg(self):
+        from boardgamegeek import BGGClient
+        import boardgamegeek as bggm
+        os.makedirs(CACHEDIR, exist_ok=True)
+        # Game details are fetched through FetchScheduler, which does its own rate
+        # limiting, so the client's fixed spacing between requests is relaxed
+        return BGGClient(cache=bggm.CacheBackendSqlite(path=CACHEDIR / "cache.db",
+                                                       ttl=COLLECTION_TTL),
+                         requests_per_minute=600)
+
+    @functools.cached_property
+    def game_cache(self):
+        from gamecache import GameCache
+        os.makedirs(CACHEDIR, exist_ok=True)
+        return GameCache(CACHEDIR / "games.db",
+                         details_ttl=GAME_DETAILS_TTL,
+                         stats_ttl=GAME_STATS_TTL,
+                         max_size=GAME_CACHE_SIZE * 2**20)
+
+    @functools.cached_property
+    def session(self):
+        # game details are cached per game by game_cache, not per request
+        import requests
+        return requests.Session()
+
+    @functools.cached_property
+    def snapshot(self):
+        from snapshot import SnapshotStore
+        os.makedirs(CACHEDIR, exist_ok=True)
+        return SnapshotStore(CACHEDIR / "snapshot.db")
 
-    return res
+    @functools.cached_property
+    def font(self):
+        # the basic layout, even where Pillow has RAQM, so that TextLayout's sums of word
+        # widths are exact. Names can wrap differently than with RAQM's kerning
+        from PIL import ImageFont
+        return ImageFont.truetype(str(RESDIR / "Roboto-Bold.ttf"), 24,
+                                  layout_engine=ImageFont.Layout.BASIC)
 
-def set_content(tree, xpath, content, ns):
-    element = tree.findall(xpath, ns)[-1]
-    element.text = str(content)
+    @functools.cached_property
+    def layout(self):
+        return TextLayout(self.font)
 
-def clear_content(tree, xpath, ns):
-    element = tree.find(xpath, ns)
-    element.clear()
+context = Context()
 
+def game_info(game):
+    """
+    Returns the LabelRecord of a game (a boardgamegeek BoardGame, or a record already).
+    """
+    if isinstance(game, LabelRecord):
+        return game
+    return LabelRecord.from_data(game.data())
 
 ns = {'inkscape': "http://www.inkscape.org/namespaces/inkscape"}
 label_xpath = "[@inkscape:label='%s']"
 group_xpath = f".//*{label_xpath}"
 span_xpath = f".//*{label_xpath}/*{label_xpath}//{{*}}tspan"
-font = ImageFont.truetype(str(RESDIR / "Roboto-Bold.ttf"), 24)
 MAX_LINELENGHT = 260 # px
 
-def fill_truncate_text(tree, property, value):
-    xpath = span_xpath % (f'{property}-group', f'{property}-text')
-    max_length_string = tree.find(xpath, ns).text
-    max_linelength = font.getlength(max_length_string)
+class TextLayout:
+    """
+    Measures text from cached per-word advance widths.
+
+    With Pillow's basic layout (no kerning or shaping) the advance of a string is exactly
+    the sum of the advances of its words and of the spaces between them. Once each word
+    has been measured, the width of any run of words comes from prefix sums, and how many
+    words fit in a line from a binary search over them.
+    """
+    def __init__(self, font):
+        self.font = font
+        self.space = font.getlength(' ')
+        self.widths = {}
+
+    def word_width(self, word):
+        try:
+            return self.widths[word]
+        except KeyError:
+            width = self.widths[word] = self.font.getlength(word)
+            return width
+
+    def prefix_widths(self, words):
+        """
+        Returns the widths of ' '.join(words[:k]) for k in 0..len(words).
+        """
+        widths = [0]
+        total = -self.space
+        for word in words:
+            total += self.space + self.word_width(word)
+            widths.append(total)
+        return widths
+
+    def width(self, text):
+        return self.prefix_widths(text.split(' '))[-1]
+
+    def fit(self, words, max_width, suffix_width=0):
+        """
+        Returns how many of words fit in max_width when joined by spaces and followed by
+        something suffix_width wide.
+        """
+        widths = self.prefix_widths(words)
+        return max(0, bisect.bisect_right(widths, max_width - suffix_width) - 1)
+
 
+# template property -> LabelRecord field
+ATTR_DICT = {
+    'name': 'name', 
+    'weight': 'weight_label',
+    'player-n': 'player_range',
+    'weight_color': 'weight_color',
+    'recommended-n': 'not_recommended_str',
+    'time': 'time_range',
+    'avgscore': 'rating',
+    'rank': 'award',
+    'tags': 'tags'
+}
+# text elements (inside $property-group) used by each property
+TEXT_SLOTS = {
+    'name': ('text-short', 'text-line1', 'text-line2'),
+    'rank': ('text-line1', 'text-line2'),
+}
+
+def fill_truncate_text(slots, property, value, max_linelength):
     if ', ' in value:
         value = value.split(', ')
     elif ',' in value:
@@ -176,202 +209,1442 @@ def fill_truncate_text(tree, property, value):
     else:
         value = value.split(' ')
 
-    while font.getlength(' '.join(value)) > max_linelength:
-        value.pop()
+    # keep as many items as fit, measured as if separated by single spaces
+    value = value[:context.layout.fit(value, max_linelength)]
 
     value = ', '.join(value)
-    set_content(tree, xpath, value, ns)
+    slots[f'{property}-text'][-1].text = value
     
 
-def fill_multi_line(tree, property, value):
-    clear_content(
-        tree, span_xpath % (f'{property}-group', f'{property}-text-short'), ns)
-    line1 = value.split()
-    line2 = []
-    while font.getlength(' '.join(line1)) > MAX_LINELENGHT:
-        line2 = [line1.pop()] + line2
-    popped = False
-    while font.getlength(' '.join(line2) + '...') > MAX_LINELENGHT:
-        popped = True
-        line2.pop()
-    if popped:
-        line2.append('...')
-    line1 = ' '.join(line1)
-    line2 = ' '.join(line2)
-    set_content(tree, 
-                span_xpath % (f'{property}-group', f'{property}-text-line1'), 
-                line1,
-                ns)
-    set_content(tree, 
-                span_xpath % (f'{property}-group', f'{property}-text-line2'), 
-                line2,
-                ns)
-
-def fill_text(tree, property, value):
+def fill_multi_line(slots, property, value):
+    slots[f'{property}-text-short'][0].clear()
+    words = value.split()
+    layout = context.layout
+    n = layout.fit(words, MAX_LINELENGHT)
+    line1 = words[:n]
+    line2 = words[n:]
+    n = layout.fit(line2, MAX_LINELENGHT, layout.width('...'))
+    if n < len(line2):
+        line2 = line2[:n] + ['...']
+    slots[f'{property}-text-line1'][-1].text = ' '.join(line1)
+    slots[f'{property}-text-line2'][-1].text = ' '.join(line2)
+
+def fill_text(slots, property, value, max_linelengths={}):
     multiline_supported = ['name']
     truncate_supported = ['tags']
     if property in multiline_supported:
-        width = font.getlength(value)
-        if width > MAX_LINELENGHT:
-            fill_multi_line(tree, property, value)
+        if context.layout.width(value) > MAX_LINELENGHT:
+            fill_multi_line(slots, property, value)
         else:
             # delete line1 and line2
-            clear_content(
-                tree, span_xpath % (f'{property}-group', f'{property}-text-line1'), ns)
-            clear_content(
-                tree, span_xpath % (f'{property}-group', f'{property}-text-line2'), ns)
-            set_content(tree, 
-                        span_xpath % (f'{property}-group', f'{property}-text-short'), 
-                        value,
-                        ns)
+            slots[f'{property}-text-line1'][0].clear()
+            slots[f'{property}-text-line2'][0].clear()
+            slots[f'{property}-text-short'][-1].text = value
     elif property in truncate_supported:
-        fill_truncate_text(tree, property, value)
+        fill_truncate_text(slots, property, value, max_linelengths[property])
     elif property == 'rank':
         _, top_n, *category = value.split(' ')
         category = ' '.join(category)
-        set_content(tree, 
-                    span_xpath % (f'{property}-group', f'{property}-text-line1'), 
-                    "Top " + top_n,
-                    ns)
-        set_content(tree, 
-                    span_xpath % (f'{property}-group', f'{property}-text-line2'), 
-                    category,
-                    ns)
+        slots[f'{property}-text-line1'][-1].text = "Top " + top_n
+        slots[f'{property}-text-line2'][-1].text = category
     else:
-        set_content(tree, 
-                    span_xpath % (f'{property}-group', f'{property}-text'), 
-                    value,
-                    ns)
+        slots[f'{property}-text'][-1].text = value
 
-def fill_template(game, svg_file=SVG_TEMPLATE):
-    tree = xmlET.parse(svg_file)
-    root = tree.getroot()
-    attr_dict = {
-        'name': 'name', 
-        'weight': 'weight_label',
-        'player-n': 'player_range',
-        'weight_color': 'weight_color',
-        'recommended-n': 'not_recommended_str',
-        'time': 'time_range',
-        'avgscore': 'rating',
-        'rank': 'award',
-        'tags': 'tags'
-    }
-    for svg_name, bg_attr in attr_dict.items():
-        value = game.get(bg_attr)
-        if type(value) == float:
-            value = '%.1f' % value
-        if type(value) == list or type(value) == tuple:
-            value = ', '.join(value)
-        if svg_name == 'recommended-n' and value:
-            value += ')'
-        if type(value) == str:
-            value = value.replace(' - ', '–')
-            value = value.replace('-', '–')
-            value = value.replace(' / ', '/')
-        try:
-            if value is None:
-                clear_content(root, group_xpath % f'{svg_name}-group', ns)
-            elif svg_name == 'weight_color':
-                weight_bg_rect = tree.find((group_xpath % 'weight-group') + '{*}rect', ns)
-                weight_bg_rect.attrib['style'] = f'fill:{value};'
+def format_value(svg_name, value):
+    """
+    Formats a LabelRecord value the way it is printed on the label.
+    """
+    if type(value) == float:
+        value = '%.1f' % value
+    if type(value) == list or type(value) == tuple:
+        value = ', '.join(value)
+    if svg_name == 'recommended-n' and value:
+        value += ')'
+    if type(value) == str:
+        value = value.replace(' - ', '–')
+        value = value.replace('-', '–')
+        value = value.replace(' / ', '/')
+    if value is not None and type(value) != str:
+        value = str(value)
+    return value
+
+class LabelTemplate:
+    """
+    An SVG label template, parsed and checked once.
+
+    Every element the labeler writes to (each $property-group, the tspans of each
+    $property-text, the weight-bg rectangle) is looked up when the template is
+    compiled and remembered as a path of child indices from the root. Filling the
+    template for a game then only copies the tree and follows those paths.
+    """
+    def __init__(self, svg_file=SVG_TEMPLATE):
+        self.svg_file = svg_file
+        self.root = xmlET.parse(svg_file).getroot()
+        parents = {child: (parent, i)
+                   for parent in self.root.iter()
+                   for i, child in enumerate(parent)}
+
+        def index_path(element):
+            path = []
+            while element is not self.root:
+                element, i = parents[element]
+                path.append(i)
+            return tuple(reversed(path))
+
+        missing = []
+        # slot name -> tuple of index paths
+        self.paths = {}
+        for svg_name in ATTR_DICT:
+            if svg_name == 'weight_color':
+                continue
+            group = f'{svg_name}-group'
+            element = self.root.find(group_xpath % group, ns)
+            if element is None:
+                missing.append(group)
+                continue
+            self.paths[group] = (index_path(element),)
+            for suffix in TEXT_SLOTS.get(svg_name, ('text',)):
+                text = f'{svg_name}-{suffix}'
+                spans = self.root.findall(span_xpath % (group, text), ns)
+                if not spans:
+                    missing.append(f'{group}/{text}')
+                    continue
+                # the first tspan is the one cleared, the last the one filled
+                self.paths[text] = (index_path(spans[0]), index_path(spans[-1]))
+        if missing:
+            raise ValueError(f"Could not find {', '.join(missing)} in {svg_file}. "
+                             "Is your SVG file correct?")
+
+        # weight-bg is optional
+        weight_bg = self.root.find((group_xpath % 'weight-group') + '{*}rect', ns)
+        if weight_bg is not None:
+            self.paths['weight-bg'] = (index_path(weight_bg),)
+
+        # the template text of truncated properties is the widest string allowed
+        self.max_linelengths = {
+            'tags': context.layout.width(self.element(self.root, self.paths['tags-text'][0]).text)
+        }
+
+    @staticmethod
+    def element(root, path):
+        for i in path:
+            root = root[i]
+        return root
+
+    def fill(self, game):
+        """
+        Returns an ElementTree of the template filled with a LabelRecord.
+        """
+        return xmlET.ElementTree(self.fill_slots(game)[0])
+
+    def fill_slots(self, game):
+        """
+        Fills a copy of the template with a LabelRecord, and returns its root with
+        the slots (name -> elements) as they were found before filling, some of which
+        filling may have cleared or removed.
+        """
+        root = copy.deepcopy(self.root)
+        slots = {name: [self.element(root, path) for path in paths]
+                 for name, paths in self.paths.items()}
+        for svg_name, bg_attr in ATTR_DICT.items():
+            value = format_value(svg_name, game.get(bg_attr))
+            if svg_name == 'weight_color':
+                if value is not None and 'weight-bg' in slots:
+                    slots['weight-bg'][0].attrib['style'] = f'fill:{value};'
+            elif value is None:
+                slots[f'{svg_name}-group'][0].clear()
             else:
-                fill_text(root, svg_name, value)
-        except AttributeError as e:
-            not_found = f"{svg_name}-group/{svg_name}-text"
-            print(f"Could not find {not_found}. Is your SVG file correct?")
-            raise e
-    return tree
+                fill_text(slots, svg_name, value, self.max_linelengths)
+        return root, slots
+
+@functools.lru_cache(maxsize=None)
+def compile_template(svg_file=SVG_TEMPLATE):
+    return LabelTemplate(svg_file)
+
+def fill_template(game, svg_file=SVG_TEMPLATE):
+    return compile_template(svg_file).fill(game)
     
-def compose_page(files, cols):
-    doc = ss.Document()
-    v_layout = ss.VBoxLayout()
-    for n in range(0,len(files),cols):
-        h_layout = ss.HBoxLayout()
-        for f in files[n:n+cols]:
-            h_layout.addSVG(f,alignment=ss.AlignTop|ss.AlignLeft)
-        v_layout.addLayout(h_layout)
-    doc.setLayout(v_layout)
-    return doc
+SVG_NS = "http://www.w3.org/2000/svg"
+XLINK_NS = "http://www.w3.org/1999/xlink"
+# SVGs are written with the SVG namespace as the default one, like they are read:
+# svglib does not find the <defs> of documents that prefix it
+xmlET.register_namespace('', SVG_NS)
+xmlET.register_namespace('xlink', XLINK_NS)
+# elements kept in both halves of a split label
+SHARED_TAGS = {f'{{{SVG_NS}}}{tag}' for tag in ('defs', 'style')}
+GROUP_TAGS = {f'{{{SVG_NS}}}{tag}' for tag in ('g', 'svg', 'a', 'switch')}
+# elements that compose_page may replace by a <use> of a single copy
+USABLE_TAGS = {f'{{{SVG_NS}}}{tag}' for tag in (
+    'g', 'path', 'rect', 'circle', 'ellipse', 'line', 'polyline', 'polygon', 'text', 'image')}
+
+def compose_page(files, cols, min_size=200):
+    """
+    Lays label SVG files out on a page, cols per row (see sheet_svg), and returns it
+    (bytes). The labels' <defs> are merged, and parts that are the same on several
+    labels (frames, icons, captions: anything but the filled in values) are only kept
+    once in the page's <defs>, each label <use>-ing them. Parts smaller than min_size
+    bytes are left in place, a <use> would not be much smaller.
+    """
+    labels = []
+    for f in files:
+        with open(f, 'rb') as svg:
+            labels.append((Path(f).stem, svg.read()))
+    page = xmlET.fromstring(sheet_svg(labels, cols))
+    defs = xmlET.Element(f'{{{SVG_NS}}}defs')
+    merged = {}
+    for parent in list(page.iter()):
+        for child in list(parent):
+            if child.tag != f'{{{SVG_NS}}}defs':
+                continue
+            for definition in list(child):
+                key = definition.get('id'), xmlET.tostring(definition)
+                if key[0] not in merged:
+                    merged[key[0]] = key[1]
+                    defs.append(definition)
+                elif merged[key[0]] != key[1]:
+                    # another definition with the same id stays where it is
+                    continue
+                child.remove(definition)
+            if not len(child):
+                parent.remove(child)
+
+    serialized = {}
+    counts = Counter()
+    def count(element):
+        for child in element:
+            if child.tag in USABLE_TAGS:
+                svg = serialized[id(child)] = xmlET.tostring(child)
+                if len(svg) >= min_size:
+                    counts[svg] += 1
+            count(child)
+    count(page)
+
+    shared = {}
+    def share(element):
+        for i, child in enumerate(element):
+            svg = serialized.get(id(child))
+            if counts[svg] < 2:
+                share(child)
+                continue
+            if svg not in shared:
+                shared[svg] = f'shared{len(shared)}'
+                definition = xmlET.SubElement(defs, f'{{{SVG_NS}}}g', id=shared[svg])
+                definition.append(child)
+            element[i] = xmlET.Element(f'{{{SVG_NS}}}use',
+                                       {f'{{{XLINK_NS}}}href': f'#{shared[svg]}'})
+    share(page)
+    if len(defs):
+        page.insert(0, defs)
+    return xmlET.tostring(page)
+
+def sheet_svg(labels, cols):
+    """
+    Lays labels ((key, svg) pairs) out on a single SVG, cols per row, and returns it
+    (bytes). A single label is returned as it is.
+    """
+    if len(labels) == 1:
+        return labels[0][1]
+    first = xmlET.fromstring(labels[0][1])
+    width, unit = re.fullmatch(r'([\d.]+)(\w*)', first.get('width')).groups()
+    height, _ = re.fullmatch(r'([\d.]+)(\w*)', first.get('height')).groups()
+    _, _, box_width, box_height = (float(n) for n in first.get('viewBox').split())
+    rows = math.ceil(len(labels) / cols)
+    cols = min(cols, len(labels))
+    sheet = xmlET.Element(f'{{{SVG_NS}}}svg', {
+        'width': f'{float(width) * cols:g}{unit}',
+        'height': f'{float(height) * rows:g}{unit}',
+        'viewBox': f'0 0 {box_width * cols:g} {box_height * rows:g}'})
+    for i, (_, label) in enumerate(labels):
+        row, col = divmod(i, cols)
+        # a group rather than a nested <svg>, which svglib does not scale right
+        group = xmlET.SubElement(sheet, f'{{{SVG_NS}}}g', transform=(
+            f'translate({col * box_width:g},{row * box_height:g})'))
+        group.extend(xmlET.fromstring(label))
+    return xmlET.tostring(sheet)
 
 def join_pdf(files, output_file):
+    from pypdf import PdfMerger
     merger = PdfMerger()
     for f in files:
         merger.append(f)
     merger.write(output_file)
     merger.close()
 
-def export(files):
-    out_files = []
+# a font set in a PDF content stream: /name size Tf
+PDF_FONT_OPERATOR = re.compile(rb'(/[^\s/\[\]()<>{}%]+)\s+[-+.\d]+\s+Tf')
+
+def pdf_digest(obj, memo):
+    """
+    Hash of a pypdf object and of everything it refers to, equal for objects with the
+    same content in different documents. memo keeps the hashes of indirect objects.
+    ReportLab gives every form the fonts of the whole document: only those its content
+    sets (with Tf) count.
+    """
+    from pypdf.generic import IndirectObject, StreamObject, DictionaryObject, ArrayObject
+    if isinstance(obj, IndirectObject):
+        key = id(obj.pdf), obj.idnum
+        if key not in memo:
+            memo[key] = pdf_digest(obj.get_object(), memo)
+        return memo[key]
+    digest = hashlib.sha256(type(obj).__name__.encode())
+    if isinstance(obj, DictionaryObject):
+        items = dict(obj.items())
+        items.pop('/Length', None)
+        if isinstance(obj, StreamObject):
+            data = obj.get_data()
+            digest.update(hashlib.sha256(data).digest())
+            if obj.get('/Subtype') == '/Form' and '/Font' in obj.get('/Resources', {}):
+                used = {name.decode() for name in PDF_FONT_OPERATOR.findall(data)}
+                resources = items['/Resources'] = dict(obj['/Resources'].items())
+                resources['/Font'] = {name: font
+                                      for name, font in obj['/Resources']['/Font'].items()
+                                      if name in used}
+        for key in sorted(items):
+            digest.update(key.encode())
+            digest.update(pdf_digest(items[key], memo))
+    elif isinstance(obj, dict):
+        for key in sorted(obj):
+            digest.update(key.encode())
+            digest.update(pdf_digest(obj[key], memo))
+    elif isinstance(obj, ArrayObject):
+        for value in obj:
+            digest.update(pdf_digest(value, memo))
+    else:
+        digest.update(repr(obj).encode())
+    return digest.digest()
+
+def join_segments(segments, output_file):
+    """
+    Joins PDFs (bytes) drawn by draw_pages into one, like join_pdf. Each of them embeds
+    the fonts and background forms it uses: fonts and forms that are the same in
+    several segments are only kept once.
+    """
+    from pypdf import PdfReader, PdfWriter
+    from pypdf.generic import NameObject
+    writer = PdfWriter()
+    # resources of earlier segments are cloned from their readers, which must live on
+    readers = []
+    memo = {}
+    shared = {}
+    for segment in segments:
+        reader = PdfReader(io.BytesIO(segment))
+        readers.append(reader)
+        for page in reader.pages:
+            resources = page['/Resources']
+            for kind in ('/Font', '/XObject'):
+                if kind not in resources:
+                    continue
+                named = resources[kind]
+                for name in list(named):
+                    ref = named.raw_get(name)
+                    named[NameObject(name)] = shared.setdefault(pdf_digest(ref, memo), ref)
+            writer.add_page(page)
+    writer.write(output_file)
+
+@functools.lru_cache(maxsize=None)
+def register_fonts():
+    import svglib.fonts
     fontpath = RESDIR / 'Roboto-Black.ttf'
     svglib.fonts.register_font('Roboto', fontpath)
     svglib.fonts.register_font('Roboto', fontpath, 'Bold')
-    for in_file in files:
+
+def _export_page(in_file, out_file, games=()):
+    from svglib.svglib import svg2rlg
+    from reportlab.graphics import renderPDF
+    try:
+        register_fonts()
+        drawing = svg2rlg(in_file)
+        # a page stopped halfway must not look newer than its SVG
+        tmp_file = f'{out_file}.{os.getpid()}.tmp'
+        renderPDF.drawToFile(drawing, tmp_file)
+        os.replace(tmp_file, out_file)
+    except Exception as e:
+        on_page = f" ({', '.join(games)})" if games else ""
+        raise RuntimeError(f"Could not export page {in_file}{on_page}: {e}") from e
+    return out_file
+
+def export(files, jobs=None, games=None):
+    """
+    Converts SVG pages to PDF pages next to them, in `jobs` processes (default: one
+    per core), and returns the PDF pages in the same order. Pages whose PDF is newer
+    than the SVG (i.e. that were not composed again) are not converted again.
+    games, if given, lists the names of the games on each page, for error messages.
+    """
+    out_files = []
+    todo = []
+    for i, in_file in enumerate(files):
         in_path = os.path.dirname(in_file) 
         in_basename = os.path.basename(os.path.splitext(in_file)[0]) 
         out_file = in_path + '/' + in_basename + '.pdf'
-        drawing = svg2rlg(in_file)
-        renderPDF.drawToFile(drawing, out_file)
+        if (not os.path.isfile(out_file)
+                or os.path.getmtime(out_file) < os.path.getmtime(in_file)):
+            todo.append((in_file, out_file, games[i] if games else ()))
         out_files.append(out_file)
+    jobs = min(jobs or os.cpu_count(), len(todo))
+    if jobs <= 1:
+        for page in todo:
+            _export_page(*page)
+    else:
+        # fonts are registered by each worker, the first time it exports a page
+        with ProcessPoolExecutor(jobs) as executor:
+            for _ in executor.map(_export_page, *zip(*todo)):
+                pass
     return out_files
 
+def paginate(files, rows, cols):
+    """
+    Cuts an iterable of labels into pages of rows x cols, in order.
+    """
+    files = iter(files)
+    while True:
+        page_files = list(itertools.islice(files, rows * cols))
+        if not page_files:
+            return
+        yield page_files
+
+def append_only_layout(labels, previous_pages, rows, cols):
+    """
+    Lays out labels so that the pages of an earlier output stay as they were: earlier
+    pages whose labels are all still there are kept, and every other label (new games,
+    changed labels, labels from pages that lost one) goes onto new pages after them.
+    labels are (key, svg) pairs, previous_pages lists of label keys.
+    """
+    by_key = dict(labels)
+    remaining = Counter(key for key, _ in labels)
+    pages = []
+    for keys in previous_pages:
+        page = Counter(keys)
+        if all(remaining[key] >= n for key, n in page.items()):
+            remaining -= page
+            pages.append([(key, by_key[key]) for key in keys])
+    new_labels = []
+    for key, svg in labels:
+        if remaining[key]:
+            remaining[key] -= 1
+            new_labels.append((key, svg))
+    return pages + list(paginate(new_labels, rows, cols))
+
+class PageManifest:
+    """
+    Which labels (by key) went onto which page of an output, for which rows and columns,
+    so that a later run can tell which pages it has to draw again.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        try:
+            with open(self.path) as f:
+                self.data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.data = {}
+
+    @staticmethod
+    def file_digest(path):
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def pages(self, rows, cols, output_file=None):
+        """
+        Returns the pages recorded for this layout (and output_file, if given, as long
+        as the file was not changed since), or [] if they cannot be reused.
+        """
+        if self.data.get('rows') != rows or self.data.get('cols') != cols:
+            return []
+        if output_file is not None:
+            if (self.data.get('output') != str(Path(output_file).resolve())
+                    or not os.path.isfile(output_file)
+                    or self.data.get('digest') != self.file_digest(output_file)):
+                return []
+        return self.data.get('pages', [])
+
+    def save(self, rows, cols, pages, output_file=None):
+        self.data = {'rows': rows, 'cols': cols, 'pages': pages}
+        if output_file is not None:
+            self.data['output'] = str(Path(output_file).resolve())
+            self.data['digest'] = self.file_digest(output_file)
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f)
+        os.replace(tmp_path, self.path)
+
+def splice_pdf(layout, previous_pdf, new_pdf):
+    """
+    Returns a PDF made of the pages of two others (all bytes): layout lists, for every
+    page, the page number to take from previous_pdf, or None to take the next page of new_pdf.
+    """
+    from pypdf import PdfReader, PdfWriter
+    previous = PdfReader(io.BytesIO(previous_pdf))
+    new_pages = iter(PdfReader(io.BytesIO(new_pdf)).pages)
+    writer = PdfWriter()
+    for previous_page in layout:
+        writer.add_page(next(new_pages) if previous_page is None
+                        else previous.pages[previous_page])
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+def split_label(svg):
+    """
+    Splits a label SVG (bytes) in its background, everything but the texts, and its
+    foreground, the texts alone in the groups (and transforms) they were in. Labels
+    from the same template mostly share the same few backgrounds.
+    """
+    background = xmlET.fromstring(svg)
+    foreground = copy.deepcopy(background)
+    for parent in background.iter():
+        for child in list(parent):
+            if child.tag == f'{{{SVG_NS}}}text':
+                parent.remove(child)
+
+    def keep_texts(element):
+        for child in list(element):
+            if child.tag in GROUP_TAGS:
+                if not keep_texts(child):
+                    element.remove(child)
+            elif child.tag != f'{{{SVG_NS}}}text' and child.tag not in SHARED_TAGS:
+                element.remove(child)
+        return any(child.tag not in SHARED_TAGS for child in element)
+    keep_texts(foreground)
+    return xmlET.tostring(background), xmlET.tostring(foreground)
+
+def draw_pages(pages, cols, previous_pages=(), previous_pdf=None, drawing_cache=None):
+    """
+    Draws pages of labels onto a PDF and returns it (bytes) with the label keys of each
+    page. Labels are (key, svg) pairs, svg being the SVG itself (bytes) or its file.
+    Fonts are registered and embedded once for the whole document, and the background
+    of labels (see split_label) is drawn once as a form that every label using it refers
+    to, so that only their texts take space on each page. pages can be any iterable:
+    without a drawing_cache, only the drawings of the current page are held in memory.
+    previous_pages are the pages (lists of label keys) of previous_pdf: pages with the
+    same labels are copied from it instead of being drawn again.
+    drawing_cache, if given, keeps the foreground drawings converted from label SVGs for
+    later calls. ReportLab changes drawings while drawing them (it sets and deletes
+    _parent on their nodes), so calls sharing a cache must not run at the same time.
+    """
+    from svglib.svglib import svg2rlg
+    from reportlab.graphics import renderPDF
+    from reportlab.pdfgen import canvas
+    register_fonts()
+    reusable = {tuple(keys): n for n, keys in enumerate(previous_pages)} if previous_pdf else {}
+    buffer = io.BytesIO()
+    pdf = canvas.Canvas(buffer, pageCompression=1, invariant=1)
+    # backgrounds are drawn as forms as soon as they are converted, so that only the
+    # names of the forms of this document are kept, never their drawings
+    forms = set()
+
+    def label_drawing(key, svg):
+        """
+        Returns the name of the label's background form and its foreground drawing.
+        """
+        cached = drawing_cache.get(key) if drawing_cache is not None else None
+        if cached is None or cached[0] not in forms:
+            if not isinstance(svg, bytes):
+                with open(svg, 'rb') as f:
+                    svg = f.read()
+            background, foreground = split_label(svg)
+            form = 'bg' + hashlib.sha256(background).hexdigest()[:16]
+            if form not in forms:
+                # also for a cached label: its form was drawn onto another document
+                drawing = svg2rlg(io.BytesIO(background))
+                pdf.beginForm(form, 0, 0, drawing.width, drawing.height)
+                renderPDF.draw(drawing, pdf, 0, 0)
+                pdf.endForm()
+                forms.add(form)
+            if cached is None:
+                cached = (form, svg2rlg(io.BytesIO(foreground)))
+                if drawing_cache is not None:
+                    drawing_cache[key] = cached
+        return cached
+
+    written = []
+    layout = []
+    for page, page_labels in enumerate(pages):
+        keys = [key for key, _ in page_labels]
+        written.append(keys)
+        layout.append(reusable.get(tuple(keys)))
+        if layout[-1] is not None:
+            LOGGER.debug(f"Page {page} is unchanged")
+            continue
+        # labels shared by several games are only converted once
+        drawings = {key: label_drawing(key, svg) for key, svg in dict(page_labels).items()}
+        width = drawings[keys[0]][1].width
+        height = drawings[keys[0]][1].height
+        page_height = height * math.ceil(len(keys) / cols)
+        pdf.setPageSize((width * min(cols, len(keys)), page_height))
+        for i, key in enumerate(keys):
+            row, col = divmod(i, cols)
+            form, foreground = drawings[key]
+            x = col * width
+            y = page_height - (row + 1) * height
+            pdf.saveState()
+            pdf.translate(x, y)
+            pdf.doForm(form)
+            pdf.restoreState()
+            renderPDF.draw(foreground, pdf, x, y)
+        pdf.showPage()
+        LOGGER.debug(f"Drew page {page}")
+    pdf.save()
+    data = buffer.getvalue()
+    if any(previous_page is not None for previous_page in layout):
+        data = splice_pdf(layout, previous_pdf, data)
+    return data, written
+
+def draw_segments(pages, cols, journal, previous_pages=(), previous_pdf=None,
+                  segment_pages=None, jobs=None, out_file=None):
+    """
+    Draws pages like draw_pages, segment_pages at a time, saving each segment to the
+    journal (a RunJournal) as soon as it is drawn. Segments the journal already has
+    with the same labels are not drawn again. Returns the PDF and the pages written.
+    Segments are separate documents, drawn in `jobs` processes (default: one per core)
+    when there is more than one, and joined with join_segments, so that the fonts and
+    background forms they share are only in the PDF once. At most `jobs` segments are
+    drawn ahead of the one being waited for.
+    With an out_file, the PDF is written to it, and so are the pages drawn so far
+    while the others are drawn: as often as segments are done, but for no more than
+    a tenth of the time, as every write joins all the segments again.
+    """
+    pages = iter(pages)
+    segment_pages = segment_pages or JOURNAL_SEGMENT_PAGES
+    jobs = jobs or os.cpu_count()
+    reusable = {tuple(keys) for keys in previous_pages} if previous_pdf else set()
+    def next_segment():
+        return list(itertools.islice(pages, segment_pages))
+    # a pool is only started for more than one segment
+    ahead = [next_segment()]
+    if jobs > 1 and ahead[0]:
+        ahead.append(next_segment())
+    executor = ProcessPoolExecutor(jobs) if ahead[-1] and len(ahead) > 1 else None
+    segments = []
+    written = []
+    # (n, page keys, PDF or Future of the PDF) of the segments not saved yet, in order
+    pending = deque()
+
+    def save(n, keys, pdf):
+        if not isinstance(pdf, bytes):
+            pdf, _ = pdf.result()
+            journal.save_segment(n, cols, keys, pdf)
+        segments.append(pdf)
+        written.extend(keys)
+
+    def joined():
+        if len(segments) <= 1:
+            return segments[0] if segments else draw_pages((), cols)[0]
+        buffer = io.BytesIO()
+        join_segments(segments, buffer)
+        return buffer.getvalue()
+
+    # when the pages so far were last written to out_file, and how long it took
+    last_write = [0, 0]
+    def write_partial():
+        start = time.perf_counter()
+        if out_file is None or start - last_write[0] < 10 * last_write[1]:
+            return
+        atomic_write(out_file, joined())
+        last_write[:] = time.perf_counter(), time.perf_counter() - start
+        LOGGER.debug(f"Wrote pages 0 to {len(written) - 1} to {out_file}")
+
+    try:
+        segment_iter = itertools.chain(ahead, iter(next_segment, []))
+        for n, segment in enumerate(itertools.takewhile(bool, segment_iter)):
+            keys = [[key for key, _ in page] for page in segment]
+            pdf = journal.segment(n, cols, keys)
+            if pdf is not None:
+                LOGGER.debug(f"Pages {n * segment_pages} to {n * segment_pages + len(keys) - 1} "
+                             "were already drawn")
+            else:
+                # the previous PDF only goes to segments that copy pages from it
+                previous = ((previous_pages, previous_pdf)
+                            if any(tuple(page) in reusable for page in keys) else ())
+                if executor is None:
+                    pdf, _ = draw_pages(segment, cols, *previous)
+                    journal.save_segment(n, cols, keys, pdf)
+                else:
+                    pdf = executor.submit(draw_pages, segment, cols, *previous)
+            pending.append((n, keys, pdf))
+            while pending and (len(pending) > jobs or isinstance(pending[0][2], bytes)
+                               or pending[0][2].done()):
+                save(*pending.popleft())
+                write_partial()
+        while pending:
+            save(*pending.popleft())
+            if pending:
+                write_partial()
+    finally:
+        if executor is not None:
+            for n, keys, pdf in pending:
+                if isinstance(pdf, bytes):
+                    continue
+                # segments done when a run stops are kept for a resumed one
+                if pdf.done() and not pdf.cancelled() and pdf.exception() is None:
+                    journal.save_segment(n, cols, keys, pdf.result()[0])
+                pdf.cancel()
+            # segments still being drawn when a run stops are not waited for
+            executor.shutdown(wait=not pending)
+    pdf = joined()
+    if out_file is not None:
+        atomic_write(out_file, pdf)
+    return pdf, written
+
+class DrawingCache:
+    """
+    The ReportLab drawings of the last `size` labels drawn, by label key: converting a
+    label's SVG is most of the time it takes to draw it. Reading and adding drawings
+    is thread-safe, drawing them is not: draw_pages calls sharing a cache take turns.
+    """
+    def __init__(self, size=1024):
+        self.size = size
+        self.drawings = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            drawing = self.drawings.get(key)
+            if drawing is not None:
+                self.drawings.move_to_end(key)
+            return drawing
+
+    def __setitem__(self, key, drawing):
+        with self.lock:
+            self.drawings[key] = drawing
+            while len(self.drawings) > self.size:
+                self.drawings.popitem(last=False)
+
+def write_pdf(files, rows, cols, output_file):
+    """
+    Draws label SVG files onto a single multi-page PDF, rows x cols labels per page,
+    laid out like compose_all + export + join_pdf would, without any intermediate file.
+    files can be any iterable, it is consumed one page at a time.
+    Returns the pages written, as lists of label keys.
+    """
+    labels = ((Path(f).stem, f) for f in files)
+    data, pages = draw_pages(paginate(labels, rows, cols), cols)
+    with open(output_file, 'wb') as f:
+        f.write(data)
+    return pages
+
+def render_labels(games, rows=6, cols=3, template=SVG_TEMPLATE, jobs=None,
+                  label_dir=None, debug_dir=None):
+    """
+    Renders the labels of games (BoardGame objects, any iterable) rows x cols per page
+    and returns the PDF as bytes. Labels, pages and the PDF all stay in memory: nothing
+    is written to disk unless label_dir is given, a cache of rendered labels shared by
+    calls, or debug_dir, where every label SVG, the page layout and the PDF are saved.
+
+    run() builds on the same steps (iter_labels, paginate, drawing the pages) rather
+    than calling this: a CLI run also keeps a journal to resume from, quarantines
+    failing games, reuses unchanged pages and draws segments in parallel.
+    """
+    labels = iter_labels(games, jobs, svg_file=template, label_dir=label_dir)
+    if debug_dir:
+        labels = debug_labels(labels, debug_dir)
+    pdf, pages = draw_pages(paginate(labels, rows, cols), cols)
+    if debug_dir:
+        debug_output(debug_dir, pages, pdf)
+    return pdf
 
-def compose_all(files, rows, cols):
+def debug_labels(labels, debug_dir):
+    os.makedirs(debug_dir, exist_ok=True)
+    for key, svg in labels:
+        if isinstance(svg, bytes):
+            with open(Path(debug_dir) / f'{key}.svg', 'wb') as f:
+                f.write(svg)
+        yield key, svg
+
+def debug_output(debug_dir, pages, pdf):
+    with open(Path(debug_dir) / 'pages.json', 'w') as f:
+        json.dump(pages, f, indent=1)
+    with open(Path(debug_dir) / 'labels.pdf', 'wb') as f:
+        f.write(pdf)
+
+def compose_all(files, rows, cols, pages=None, previous_pages=()):
+    """
+    Composes SVG pages of rows x cols labels (or of the given pages of labels) in
+    BUILDDIR/pages. Pages with the same labels as in previous_pages are left as they are.
+    """
+    if pages is None:
+        pages = paginate(files, rows, cols)
     page_files = []
-    for i, n in enumerate(range(0,len(files),rows * cols)):
+    for i, page_labels in enumerate(pages):
         out_file = BUILDDIR / f'pages/page{i}.svg'
-        LOGGER.debug(f"Composing page {i}")
-        page = compose_page(files[n:n + rows * cols], cols)
-        page.save(out_file)
+        keys = [Path(f).stem for f in page_labels]
+        if i < len(previous_pages) and previous_pages[i] == keys and os.path.isfile(out_file):
+            LOGGER.debug(f"Page {i} is unchanged")
+        else:
+            LOGGER.debug(f"Composing page {i}")
+            atomic_write(out_file, compose_page(page_labels, cols))
         page_files.append(out_file)
     return page_files
 
 def get_game_collection(username):
     print(f"Getting game collection for {username}...")
-    game_collection = bgg.collection(
+    game_collection = context.bgg.collection(
         username,
         exclude_subtype='boardgameexpansion')
     return game_collection
 
-def write_svg(game, overwrite=False): 
-    id = game.id
-    out_path = BUILDDIR / f'games/{id}.svg'
-    # LOGGER.info('Exporting ' + game.name)
-    if overwrite or not os.path.isfile(out_path):
-        thegame = game_info(game)
-        tree = fill_template(thegame)
-        tree.write(out_path)
+@functools.lru_cache(maxsize=None)
+def template_digest(svg_file=SVG_TEMPLATE):
+    """
+    Hash of everything besides game data that a rendered label depends on.
+    """
+    digest = hashlib.sha256(f'{LABEL_CACHE_VERSION}'.encode())
+    for path in (svg_file, RESDIR / 'Roboto-Bold.ttf', RESDIR / 'Roboto-Black.ttf'):
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.digest()
+
+def label_key(info, svg_file=SVG_TEMPLATE):
+    """
+    Content address of the label of a LabelRecord: games whose labels would look
+    the same get the same key.
+    """
+    content = {bg_attr: info.get(bg_attr) for bg_attr in ATTR_DICT.values()}
+    digest = hashlib.sha256(template_digest(svg_file))
+    digest.update(json.dumps(content, sort_keys=True).encode())
+    return digest.hexdigest()[:32]
+
+class LabelCache:
+    """
+    Index of the labels rendered in LABELDIR, mapping each label key to the size and
+    last use of its SVG.
+
+    Labels themselves are written by write_svg() (possibly in worker processes), the
+    index is only updated by the main process after each batch, which is also when the
+    least recently used labels are evicted to stay within max_size bytes.
+    """
+    def __init__(self, directory=None, max_size=LABEL_CACHE_SIZE * 2**20):
+        self.directory = Path(directory or LABELDIR)
+        self.index_path = self.directory / 'index.json'
+        self.max_size = max_size
+        try:
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.index = {}
+
+    def touch(self, paths):
+        now = time.time()
+        for path in paths:
+            self.index[Path(path).stem] = [os.path.getsize(path), now]
+
+    def evict(self, keep=()):
+        keep = {Path(path).stem for path in keep}
+        total = sum(size for size, _ in self.index.values())
+        for key, (size, _) in sorted(self.index.items(), key=lambda item: item[1][1]):
+            if total <= self.max_size:
+                break
+            if key in keep:
+                continue
+            try:
+                os.remove(self.directory / f'{key}.svg')
+            except FileNotFoundError:
+                pass
+            del self.index[key]
+            total -= size
+
+    def save(self):
+        tmp_path = self.index_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+def write_svg(game, use_cache=True): 
+    """
+    Renders the label of a game into the label cache, unless an identical label is
+    already there, and returns its path.
+    """
+    info = game_info(game)
+    out_path = LABELDIR / f'{label_key(info)}.svg'
+    if not use_cache or not os.path.isfile(out_path):
+        tree = fill_template(info)
+        # write then rename, so that a label is never seen half-written
+        tmp_path = out_path.with_suffix(f'.{os.getpid()}.tmp')
+        tree.write(tmp_path)
+        os.replace(tmp_path, out_path)
     return out_path
 
-    # tree.write('svg-out.svg')
+def render_label(game, svg_file=SVG_TEMPLATE, label_dir=None):
+    """
+    Returns the key and the SVG (bytes) of the label of a game. With a label_dir,
+    a label already rendered there is reused, and a new one saved to it.
+    """
+    info = game_info(game)
+    key = label_key(info, svg_file)
+    path = Path(label_dir) / f'{key}.svg' if label_dir else None
+    if path:
+        try:
+            with open(path, 'rb') as f:
+                return key, f.read()
+        except FileNotFoundError:
+            pass
+    svg = xmlET.tostring(fill_template(info, svg_file).getroot())
+    if path:
+        # write then rename, so that a label is never seen half-written
+        tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(svg)
+        os.replace(tmp_path, path)
+    return key, svg
+
+def render_template_labels(game, svg_files, label_dir=None):
+    """
+    Returns the (key, svg) labels of a game made with each of svg_files (see
+    render_label), from one LabelRecord.
+    """
+    info = game_info(game)
+    return [render_label(info, svg_file, label_dir) for svg_file in svg_files]
+
+def _label_job(function, game, *args):
+    try:
+        return function(game, *args)
+    except Exception as e:
+        raise RuntimeError(f"Could not make a label for {game.name} (id {game.id}): {e}") from e
+
+def map_games(function, games, *args, jobs=None, window=None, on_error=None):
+    """
+    Yields function(game, *args) for every game, in the order of games, computed in
+    `jobs` processes (default: one per core).
+    games can be any iterable, e.g. games still arriving from a FetchScheduler. At most
+    `window` games (default: four per process) are taken from it ahead of the result
+    being yielded, so memory does not grow with the number of games. Processes are
+    sent the LabelRecord of each game (see game_info), not the game itself, which
+    takes much longer to pickle.
+    With on_error, a game that fails is skipped after calling on_error(game, error),
+    instead of raising.
+    """
+    def result(game, job, *job_args):
+        try:
+            return True, job(*job_args)
+        except Exception as e:
+            if on_error is None:
+                raise
+            on_error(game, e)
+            return False, None
+
+    if jobs == 1:
+        for game in games:
+            done, value = result(game, _label_job, function, game, *args)
+            if done:
+                yield value
+        return
+    jobs = jobs or os.cpu_count()
+    window = window or 4 * jobs
+    pending = deque()
+    with ProcessPoolExecutor(jobs) as executor:
+        try:
+            for game in games:
+                done, record = result(game, _label_job, game_info, game)
+                if done:
+                    pending.append((game, executor.submit(_label_job, function, record, *args)))
+                if len(pending) >= window:
+                    queued, future = pending.popleft()
+                    done, value = result(queued, future.result)
+                    if done:
+                        yield value
+            while pending:
+                queued, future = pending.popleft()
+                done, value = result(queued, future.result)
+                if done:
+                    yield value
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+def iter_labels(games, jobs=None, window=None, svg_file=SVG_TEMPLATE, label_dir=None,
+                on_error=None):
+    """
+    Yields the (key, svg) label of every game, in order (see render_label and map_games).
+    """
+    return map_games(render_label, games, svg_file, label_dir, jobs=jobs, window=window,
+                     on_error=on_error)
+
+def iter_svgs(games, use_cache=True, jobs=None, window=None, on_error=None):
+    """
+    Yields the label file of every game, in order (see write_svg and map_games).
+    """
+    return map_games(write_svg, games, use_cache, jobs=jobs, window=window,
+                     on_error=on_error)
+
+def sync_delta(snapshot, username, collection):
+    """
+    Returns the items of collection that were added or modified since the last sync
+    of username.
+    """
+    from snapshot import collection_delta
+    added, removed, modified = collection_delta(
+        snapshot.synced_collection(username), collection)
+    print(f"Since the last sync: {len(added)} added, {len(modified)} modified, "
+          f"{len(removed)} removed")
+    if removed:
+        LOGGER.debug(f"Removed from the collection: {removed}")
+    changed = set(added) | set(modified)
+    return [(id, last_modified) for id, last_modified in collection if id in changed]
+
+def snapshot_command(args):
+    """
+    Runs --export-snapshot / --import-snapshot.
+    """
+    snapshot = context.snapshot
+    if args.import_snapshot:
+        games, users = snapshot.import_(args.import_snapshot)
+        print(f"Imported {games} games and {users} collections")
+    if args.export_snapshot:
+        snapshot.export(args.export_snapshot)
+        print(f"Snapshot written to {args.export_snapshot}")
+
+def merge_command(args):
+    """
+    Runs --merge: assembles the PDF of a run from the directories of its --shard runs.
+    """
+    import shards
+    pages = shards.merge(args.merge, args.out_file)
+    print(f"{pages} pages from {len(args.merge)} shards written to {args.out_file}")
+
+def read_job_file(job_file):
+    """
+    Reads a batch job file: one username per line, optionally followed by the output
+    file of that user. Blank lines and lines starting with # are skipped.
+    """
+    jobs = []
+    with open(job_file) as f:
+        for line in f:
+            fields = line.split('#', 1)[0].split()
+            if fields:
+                jobs.append((fields[0], fields[1] if len(fields) > 1 else None))
+    return jobs
+
+def run_batch(args):
+    """
+    Prints the collections of several users: collections are fetched concurrently,
+    then every distinct game is fetched and rendered once for all of them, and each
+    user gets a PDF (or all share one, with --combined) drawn from the shared labels.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from tqdm import tqdm
+    os.makedirs(BUILDDIR, exist_ok=True)
+    if args.cache:
+        os.makedirs(LABELDIR, exist_ok=True)
+    jobs = [(username, None) for username in args.users or ()]
+    if args.job_file:
+        jobs += read_job_file(args.job_file)
+    out_file = Path(args.out_file)
+
+    tracer = Tracer(profile_stage=args.cprofile)
+    snapshot = context.snapshot
+    scheduler = FetchScheduler(context.session,
+                               chunk_size=args.chunk_size,
+                               max_in_flight=args.max_requests,
+                               requests_per_second=args.requests_per_second,
+                               cache=context.game_cache,
+                               refresh=args.refresh,
+                               collection_ttl=COLLECTION_TTL)
+    with tracer.stage('collection') as stage:
+        print(f"Getting {len(jobs)} collections...")
+        with ThreadPoolExecutor(args.max_requests) as executor:
+            collections = list(executor.map(scheduler.collection,
+                                            [username for username, _ in jobs]))
+        for (username, _), collection in zip(jobs, collections):
+            snapshot.save_collection(username, collection)
+        collections = [[id for id, _ in collection] for collection in collections]
+        all_ids = list(dict.fromkeys(id for collection in collections for id in collection))
+        stage.items += len(collections)
+
+    print(f"Getting information for {len(all_ids)} games and exporting SVGs...")
+    games = tracer.iterate('fetch', snapshot.record(scheduler.games(all_ids)))
+    fetched_ids = []
+    def ids(games):
+        for game in games:
+            fetched_ids.append(game.id)
+            yield game
+    rendered = iter_labels(ids(games), args.jobs, label_dir=LABELDIR if args.cache else None)
+    # game id -> label key -> label, so that games with identical labels share one
+    label_of = {}
+    labels = {}
+    for i, (key, svg) in enumerate(tqdm(tracer.iterate('render', rendered),
+                                        total=len(all_ids))):
+        label_of[fetched_ids[i]] = key
+        labels[key] = svg
+
+    def user_pages(collection):
+        user_labels = [(label_of[id], labels[label_of[id]])
+                       for id in collection if id in label_of]
+        return paginate(user_labels, args.rows, args.columns)
+    drawing_cache = DrawingCache(size=max(len(labels), 1))
+    outputs = []
+    with tracer.stage('pdf') as stage:
+        if args.combined:
+            pages = (page for collection in collections for page in user_pages(collection))
+            pdf, page_keys = draw_pages(pages, args.columns, drawing_cache=drawing_cache)
+            outputs.append((out_file, pdf))
+            stage.items += len(page_keys)
+        else:
+            for (username, user_file), collection in zip(jobs, collections):
+                pdf, page_keys = draw_pages(user_pages(collection), args.columns,
+                                            drawing_cache=drawing_cache)
+                user_file = user_file or out_file.with_name(
+                    f'{out_file.stem}-{username}{out_file.suffix}')
+                outputs.append((user_file, pdf))
+                stage.items += len(page_keys)
+        for path, pdf in outputs:
+            with open(path, 'wb') as f:
+                f.write(pdf)
+    if args.cache:
+        label_cache = LabelCache(max_size=args.cache_size * 2**20)
+        label_paths = [LABELDIR / f'{key}.svg' for key in labels]
+        label_cache.touch(label_paths)
+        label_cache.evict(keep=label_paths)
+        label_cache.save()
+    with tracer.stage('revalidate'):
+        scheduler.revalidate().join()
+        context.game_cache.flush()
+
+    total = sum(len(collection) for collection in collections)
+    saved = total - len(all_ids)
+    print(f"{len(jobs)} collections, {total} labels: {len(all_ids)} distinct games "
+          f"fetched and rendered once each in {scheduler.requests} BGG requests, "
+          f"{saved} fetches and renders saved ({saved / total if total else 0:.0%}), "
+          f"{len(labels)} distinct labels drawn")
+    for path, _ in outputs:
+        print(f"Wrote {path}")
+    if args.profile:
+        tracer.log_summary()
+    if args.trace:
+        tracer.write(args.trace)
+    tracer.dump_profile()
+    print("All done!")
+
+class Cancelled(Exception):
+    """
+    Raised in a run that was asked to stop (see RunProgress).
+    """
+
+class RunProgress:
+    """
+    Reports how a run is going to progress(stage, done, total, item), a function called
+    from the thread of the run (total is None when unknown): 'collection' once the
+    games to print are known (done: how many), then 'fetch' for every game (item: its LabelRecord), 'render'
+    for every label (item: its key and its SVG, bytes or a path, or its image with
+    --png) and 'pages' for every page laid out.
+    Once cancel (a threading.Event) is set, check() raises Cancelled. The run checks
+    before taking each game, and while waiting for BGG: the exception then goes up
+    through every stage, which stop their processes on the way.
+    """
+    def __init__(self, progress=None, cancel=None):
+        self.progress = progress
+        self.cancel = cancel
+
+    def check(self):
+        if self.cancel is not None and self.cancel.is_set():
+            raise Cancelled("The run was stopped")
+
+    def report(self, stage, done, total=None, item=None):
+        if self.progress is not None:
+            self.progress(stage, done, total, item)
 
-def run(args):
-    if not os.path.isdir(BUILDDIR):
-        os.makedirs(BUILDDIR)
-    if not os.path.isdir(BUILDDIR / 'games'):
-        os.mkdir(BUILDDIR / 'games')
-    if not os.path.isdir(BUILDDIR / 'pages'):
-        os.mkdir(BUILDDIR / 'pages')
+def run(args, progress=None, cancel=None):
+    """
+    Prints the labels asked for by args (see main.py). progress and cancel let a GUI
+    follow the run and stop it, see RunProgress; a stopped run raises Cancelled and can
+    be resumed.
+    """
+    from tqdm import tqdm
+    # a template that cannot be used stops the run before anything is fetched
+    if args.outputs:
+        for svg_file, *_ in args.outputs:
+            compile_template(svg_file)
+    elif args.png:
+        import raster
+        raster.raster_template(SVG_TEMPLATE, args.dpi)
+    else:
+        compile_template(SVG_TEMPLATE)
+    # labels and pages only go to disk when cached, or with --via-svg-pages
+    os.makedirs(BUILDDIR, exist_ok=True)
+    os.makedirs(CACHEDIR, exist_ok=True)
+    if args.cache or args.via_svg_pages:
+        os.makedirs(LABELDIR, exist_ok=True)
+    if args.via_svg_pages:
+        os.makedirs(BUILDDIR / 'pages', exist_ok=True)
 
-    if args.bgg_id:
+    tracer = Tracer(profile_stage=args.cprofile)
+    progress = RunProgress(progress, cancel)
+    snapshot = context.snapshot
+    # shards of a run may share a machine, and so the cache directory
+    journal = RunJournal(CACHEDIR / ('journal-shard-{}-of-{}'.format(*args.shard)
+                                     if args.shard else 'journal'))
+    resumed = journal.start(args.resume)
+    source = {'username': args.username, 'bgg_id': args.bgg_id, 'sync': args.sync,
+              'since': str(args.since) if args.since else None}
+    if resumed and journal.get('source') == source and journal.get('game_ids') is not None:
+        # the games of the run being resumed, rather than the collection as it is now
+        game_ids = journal.get('game_ids')
+        synced = journal.get('synced')
+    elif args.bgg_id:
         game_ids = [args.bgg_id]
     else:
-        game_collection = get_game_collection(args.username)
-        collection_games = game_collection.items
-        if args.since:
-            collection_games = [g for g in collection_games if datetime.fromisoformat(g.last_modified).date() >= args.since]
-        game_ids = [game.id for game in collection_games]
-
-    print("Getting game information from BGG...")
-    games = bgg.game_list(game_ids)
-    svg_paths = []
-    print("Exporting SVGs...")
-    for game in tqdm(games):
-        out_path = write_svg(game, args.cache)
-        svg_paths.append(out_path)
-    print("Composing SVGs...")
-    svg_pages = compose_all(svg_paths, args.rows, args.columns)
-    print("Exporting SVG pages to PDF...")
-    out_pdfs = export(svg_pages)
-    join_pdf(out_pdfs, args.out_file)
+        with tracer.stage('collection') as stage:
+            if args.offline:
+                collection = snapshot.collection(args.username)
+                if not collection:
+                    raise ValueError(f"No snapshot of {args.username}'s collection, "
+                                     "run once without --offline first")
+            else:
+                game_collection = get_game_collection(args.username)
+                collection = [(g.id, g.last_modified) for g in game_collection.items]
+                snapshot.save_collection(args.username, collection)
+            if args.sync:
+                synced = collection
+                collection = sync_delta(snapshot, args.username, collection)
+            if args.since:
+                collection = [(id, last_modified) for id, last_modified in collection
+                              if datetime.fromisoformat(last_modified).date() >= args.since]
+            game_ids = [id for id, _ in collection]
+            stage.items += len(game_ids)
+        if args.sync and not game_ids:
+            snapshot.save_synced_collection(args.username, synced)
+            journal.finish()
+            print("Nothing to print")
+            return
+    journal.set('source', source)
+    journal.set('game_ids', game_ids)
+    if args.sync:
+        journal.set('synced', synced)
+    progress.report('collection', len(game_ids))
+    if args.shard:
+        import shards
+        shard = shards.Shard(shards.shard_dir(args.out_file, *args.shard), *args.shard,
+                             game_ids, args.rows, args.columns)
+        shard.start()
+        game_ids = shard.game_ids
+
+    # games fetched by the run being resumed are not fetched again
+    fetched = journal.records() if resumed else {}
+    todo = [id for id in game_ids if id not in fetched]
+    if fetched:
+        print(f"{len(game_ids) - len(todo)} games already fetched")
+    if args.offline:
+        print("Getting game information from the snapshot and exporting SVGs...")
+        new_games = snapshot.stored_games(todo)
+    else:
+        print("Getting game information from BGG and exporting SVGs...")
+        scheduler = FetchScheduler(context.session,
+                                   chunk_size=args.chunk_size,
+                                   max_in_flight=args.max_requests,
+                                   requests_per_second=args.requests_per_second,
+                                   cache=context.game_cache,
+                                   refresh=args.refresh,
+                                   interrupt=progress.check)
+        new_games = snapshot.record(scheduler.games(todo))
+    quarantined_ids = set()
+    def quarantine(game, error):
+        journal.quarantine(game, error)
+        quarantined_ids.add(game.id)
+        # when the first games all fail, it is not the games
+        if not keys and len(journal.quarantined) >= QUARANTINE_LIMIT:
+            raise error
+    def journaled(new_games):
+        """
+        Yields the records of game_ids in order, from the journal or made from new_games
+        (in the same order, without the games BGG had nothing for) and added to it.
+        """
+        new_games = iter(new_games)
+        next_game = None
+        count = 0
+        try:
+            for game_id in game_ids:
+                progress.check()
+                record = fetched.get(game_id)
+                if record is None:
+                    if next_game is None:
+                        next_game = next(new_games, None)
+                    if next_game is None or next_game.id != game_id:
+                        continue
+                    game, next_game = next_game, None
+                    try:
+                        record = _label_job(game_info, game)
+                    except Exception as e:
+                        quarantine(game, e)
+                        continue
+                    journal.add_record(record)
+                count += 1
+                progress.report('fetch', count, len(game_ids), record)
+                yield record
+        finally:
+            # also when the run is stopped, so that a resumed run has these games
+            journal.flush()
+            if hasattr(new_games, 'close'):
+                new_games.close()
+    fetching = journaled(new_games)
+    games = tracer.iterate('fetch', fetching)
+    keys = []
+    game_names = []
+    def named(games):
+        for game in games:
+            game_names.append((game.id, game.name))
+            yield game
+    def labels(rendered):
+        for label in tqdm(tracer.iterate('render', rendered), total=len(game_ids)):
+            keys.append(label[0] if isinstance(label, tuple) else Path(label).stem)
+            progress.report('render', len(keys), len(game_ids),
+                            label if isinstance(label, tuple) else (keys[-1], label))
+            yield label
+    def with_ids(rendered):
+        # a game that fails is quarantined before the label of the next one comes
+        names = iter(game_names)
+        for label in rendered:
+            game_id = next(names)[0]
+            while game_id in quarantined_ids:
+                game_id = next(names)[0]
+            yield game_id, label
+    def laid_out(pages):
+        total = -(-len(game_ids) // (args.rows * args.columns))
+        for n, page in enumerate(pages, 1):
+            progress.report('pages', n, max(n, total))
+            yield page
+    try:
+        if args.png:
+            # bitmaps for label printers, drawn without going through SVG or PDF
+            import raster
+            rendered = labels(map_games(raster.render_raster, named(games), SVG_TEMPLATE, args.dpi,
+                                        jobs=args.jobs, on_error=quarantine))
+            with tracer.stage('png') as stage:
+                if args.png_sheets:
+                    stage.items += raster.write_pngs(rendered, args.png, args.dpi,
+                                                     args.rows, args.columns)
+                else:
+                    stage.items += raster.write_pngs(rendered, args.png, args.dpi)
+            print(f"PNGs written to {args.png}")
+        elif args.via_svg_pages:
+            # every label and page goes through a file, for debugging
+            labels = [(Path(f).stem, f)
+                      for f in labels(iter_svgs(named(games), args.cache, args.jobs,
+                                                on_error=quarantine))]
+            quarantined = {game['id'] for game in journal.quarantined}
+            names = {}
+            for key, (_, name) in zip(keys, [game for game in game_names
+                                             if game[0] not in quarantined]):
+                names.setdefault(key, []).append(name)
+            manifest = PageManifest(CACHEDIR / 'svg-pages-manifest.json')
+            previous_pages = manifest.pages(args.rows, args.columns) if args.cache else []
+            if args.layout == 'append':
+                pages = append_only_layout(labels, previous_pages, args.rows, args.columns)
+            else:
+                pages = list(paginate(labels, args.rows, args.columns))
+            page_keys = [[key for key, _ in page] for page in pages]
+            # pages composed by the run being resumed are not composed again
+            composed = journal.get('pages', []) if resumed else previous_pages
+            journal.set('pages', page_keys)
+            progress.check()
+            print("Composing SVGs...")
+            with tracer.stage('compose') as stage:
+                svg_pages = compose_all([f for _, f in labels], args.rows, args.columns,
+                                        [[f for _, f in page] for page in pages], composed)
+                stage.items += len(svg_pages)
+            progress.report('pages', len(svg_pages), len(svg_pages))
+            progress.check()
+            print("Exporting SVG pages to PDF...")
+            with tracer.stage('export') as stage:
+                out_pdfs = export(svg_pages, args.jobs,
+                                  [[name for key in dict.fromkeys(page) for name in names[key]]
+                                   for page in page_keys])
+                stage.items += len(out_pdfs)
+            with tracer.stage('join') as stage:
+                join_pdf(out_pdfs, args.out_file)
+                stage.items += len(out_pdfs)
+            manifest.save(args.rows, args.columns, page_keys)
+        elif args.outputs:
+            # several templates and sheet sizes: games are fetched and made into records once,
+            # and labelled once for each template, whichever outputs share it
+            svg_files = list(dict.fromkeys(svg_file for svg_file, *_ in args.outputs))
+            # labels go to disk (to the journal without the label cache), and only their
+            # keys are kept: each output then reads its labels back a page at a time
+            label_dir = LABELDIR if args.cache else journal.label_dir
+            rendered = map_games(render_template_labels, named(games), svg_files, label_dir,
+                                 jobs=args.jobs, on_error=quarantine)
+            # for each template, the label key of every game
+            template_keys = [[] for _ in svg_files]
+            for game_labels in tqdm(tracer.iterate('render', rendered), total=len(game_ids)):
+                for n, (key, _) in enumerate(game_labels):
+                    template_keys[n].append(key)
+                    keys.append(key)
+                progress.report('render', len(template_keys[0]), len(game_ids), game_labels[0])
+            with tracer.stage('pdf') as stage:
+                for output, (svg_file, rows, cols, out_file) in enumerate(args.outputs):
+                    output_labels = ((key, label_dir / f'{key}.svg')
+                                     for key in template_keys[svg_files.index(svg_file)])
+                    pdf, page_keys = draw_segments(paginate(output_labels, rows, cols), cols,
+                                                   journal.output(output), jobs=args.jobs,
+                                                   out_file=out_file)
+                    stage.items += len(page_keys)
+                    print(f"Wrote {out_file}")
+        elif args.shard:
+            # only the blocks of this shard, which --merge puts together with the others
+            rendered = labels(iter_labels(named(games), args.jobs, label_dir=shard.label_dir,
+                                          on_error=quarantine))
+            with tracer.stage('pdf') as stage:
+                stage.items += shard.draw(with_ids(rendered))
+            print(f"Shard {args.shard[0]} of {args.shard[1]} written to {shard.directory}")
+        else:
+            manifest = PageManifest(CACHEDIR / 'manifest.json')
+            previous_pages = (manifest.pages(args.rows, args.columns, args.out_file)
+                              if args.cache else [])
+            previous_pdf = None
+            if previous_pages:
+                with open(args.out_file, 'rb') as f:
+                    previous_pdf = f.read()
+            # without the label cache, labels are kept in the journal until the run is done
+            rendered = labels(iter_labels(named(games), args.jobs,
+                                          label_dir=LABELDIR if args.cache else journal.label_dir,
+                                          on_error=quarantine))
+            if args.debug_dir:
+                rendered = debug_labels(rendered, args.debug_dir)
+            with tracer.stage('pdf') as stage:
+                if args.layout == 'append':
+                    # the layout depends on every label, so they are all rendered first
+                    pages = append_only_layout(list(rendered), previous_pages,
+                                               args.rows, args.columns)
+                else:
+                    # fetching, rendering and drawing pages all advance together, a page at a time
+                    pages = paginate(rendered, args.rows, args.columns)
+                # the pages drawn so far are in out_file while the others are drawn
+                pdf, page_keys = draw_segments(laid_out(pages), args.columns, journal,
+                                               previous_pages, previous_pdf, jobs=args.jobs,
+                                               out_file=args.out_file)
+                stage.items += len(page_keys)
+            if args.debug_dir:
+                debug_output(args.debug_dir, page_keys, pdf)
+            manifest.save(args.rows, args.columns, page_keys, args.out_file)
+    finally:
+        # whichever way the stages end, the records fetched so far go to the journal
+        # now, and fetching stops
+        fetching.close()
+    if (args.cache or args.via_svg_pages) and not args.png and not args.shard:
+        with tracer.stage('cache') as stage:
+            label_paths = [LABELDIR / f'{key}.svg' for key in keys]
+            label_cache = LabelCache(max_size=args.cache_size * 2**20)
+            label_cache.touch(set(label_paths))
+            label_cache.evict(keep=label_paths)
+            label_cache.save()
+            stage.items += len(set(keys))
+    if args.sync:
+        # only now that the labels are printed, so that a failed run is synced again
+        snapshot.save_synced_collection(args.username, synced)
+    if journal.quarantined:
+        print(f"{len(journal.quarantined)} games could not be labeled and were skipped:")
+        for game in journal.quarantined:
+            print(f"  {game['error']}")
+    journal.finish()
+    if not args.offline:
+        # the PDF is done, refresh games whose statistics are getting old for next time
+        with tracer.stage('revalidate') as stage:
+            stage.items += len(scheduler.stale_ids)
+            scheduler.revalidate().join()
+            context.game_cache.flush()
+        stats = context.game_cache.stats()
+        LOGGER.info(f"Game cache: {stats['hits']} hits, {stats['stale']} stale, "
+                    f"{stats['misses']} misses")
+    LOGGER.debug(f"{len(keys)} labels, {len(set(keys))} distinct")
+    if args.profile:
+        tracer.log_summary()
+    if args.trace:
+        tracer.write(args.trace)
+    tracer.dump_profile()
     print("All done!")
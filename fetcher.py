@@ -0,0 +1,250 @@
+"""
+Chunked, concurrent fetching of game details from the BGG XML API.
+
+BGG only answers a limited number of ids per request, and answers 202/429/503
+when it wants clients to slow down. FetchScheduler splits the id list in chunks,
+keeps a bounded number of requests in flight under a requests-per-second budget,
+halves that budget whenever BGG pushes back and yields games as their chunk arrives
+so that labels can be rendered while the rest of the collection is downloading.
+"""
+import time
+import logging
+import threading
+import collections
+import xml.etree.ElementTree as xmlET
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from gamecache import FRESH
+
+LOGGER = logging.getLogger('main')
+
+BGG_API = "https://www.boardgamegeek.com/xmlapi2"
+# statuses BGG uses to say "try again later"
+THROTTLE_STATUS = (202, 429, 503)
+
+class Throttled(Exception):
+    def __init__(self, status, retry_after=None):
+        super().__init__(f"BGG answered {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+class TokenBucket:
+    """
+    Hands out `rate` tokens per second. slow_down() and speed_up() adjust the rate
+    between `min_rate` and the initial rate (multiplicative decrease, additive increase).
+    """
+    def __init__(self, rate, min_rate=None):
+        self.max_rate = rate
+        self.min_rate = min_rate or rate / 16
+        self.rate = rate
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = max(0, self.next_time - now)
+            self.next_time = max(now, self.next_time) + 1 / self.rate
+        if wait_time:
+            time.sleep(wait_time)
+
+    def slow_down(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            LOGGER.debug(f"Throttled by BGG, now at {self.rate:.2f} requests/s")
+
+    def speed_up(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+class FetchScheduler:
+    """
+    Fetches game details for a list of ids through a requests `session`.
+    If a GameCache is given, cached games are used instead of requests: stale ones
+    are revalidated in the background once the games that were missing have been
+    fetched (see revalidate()). With refresh, every game is fetched again (and the
+    cache updated). Collections are cached too, for collection_ttl seconds (not at all
+    by default), and also fetched again with refresh.
+    If given, interrupt() is called every `poll` seconds while waiting for BGG, and
+    stops the fetching if it raises: requests still running are left to finish in
+    the background, instead of being waited for.
+    """
+    def __init__(self, session, api_endpoint=BGG_API, chunk_size=20, max_in_flight=4,
+                 requests_per_second=0.5, max_retries=8, retry_delay=2, timeout=30,
+                 cache=None, refresh=False, bucket=None, interrupt=None, poll=0.2,
+                 collection_ttl=0):
+        self.session = session
+        self.thing_url = api_endpoint + "/thing"
+        self.collection_url = api_endpoint + "/collection"
+        self.chunk_size = chunk_size
+        self.max_in_flight = max_in_flight
+        # schedulers working side by side can share a bucket, and so a budget
+        self.bucket = bucket or TokenBucket(requests_per_second)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.cache = cache
+        self.refresh = refresh
+        self.collection_ttl = collection_ttl
+        self.interrupt = interrupt
+        self.poll = poll
+        self.stale_ids = []
+        self.requests = 0
+        self.throttled = 0
+
+    def get(self, url, params, attempt=0, retry_after=None):
+        if attempt:
+            delay = retry_after or self.retry_delay * 2 ** (attempt - 1)
+            time.sleep(min(delay, 60))
+        self.bucket.take()
+        self.requests += 1
+        r = self.session.get(url, params=params, timeout=self.timeout)
+        if r.status_code in THROTTLE_STATUS:
+            retry_after = r.headers.get('Retry-After')
+            raise Throttled(r.status_code,
+                            float(retry_after) if retry_after and retry_after.isdigit() else None)
+        r.raise_for_status()
+        return xmlET.fromstring(r.content)
+
+    def collection(self, username):
+        """
+        Returns the collection of username (without expansions) as (game id,
+        last_modified) pairs. BGG answers 202 while it prepares a collection, which is
+        retried like throttling.
+        """
+        if self.cache and self.collection_ttl and not self.refresh:
+            items = self.cache.get_collection(username, self.collection_ttl)
+            if items is not None:
+                return items
+        params = {'username': username, 'excludesubtype': 'boardgameexpansion'}
+        attempt = 0
+        retry_after = None
+        while True:
+            try:
+                root = self.get(self.collection_url, params, attempt, retry_after)
+                break
+            except Throttled as e:
+                self.throttled += 1
+                if attempt >= self.max_retries:
+                    raise RuntimeError(f"BGG did not return the collection of {username}") from e
+                attempt += 1
+                retry_after = e.retry_after
+        if root.tag == 'errors':
+            raise ValueError(f"BGG: {' '.join(root.itertext()).strip()}")
+        items = [(int(item.attrib['objectid']), item.find('status').attrib.get('lastmodified'))
+                 for item in root.findall('item')]
+        if self.cache and self.collection_ttl:
+            self.cache.put_collection(username, items)
+        return items
+
+    def fetch_chunk(self, ids, attempt=0, retry_after=None):
+        """
+        Requests the items of ids, stores them in the cache and returns them as a
+        {game id: xml element} dict.
+        """
+        root = self.get(self.thing_url, {'id': ','.join(str(i) for i in ids), 'stats': 1},
+                        attempt, retry_after)
+        items = {int(item.attrib['id']): item for item in root.findall('item')}
+        if self.cache:
+            self.cache.put((game_id, xmlET.tostring(item)) for game_id, item in items.items())
+        return items
+
+    def fetch_chunks(self, chunks):
+        """
+        Yields (chunk index, items) as chunks complete, keeping at most max_in_flight
+        requests going and retrying throttled ones.
+        """
+        pending = {}
+        next_chunk = 0
+        executor = ThreadPoolExecutor(self.max_in_flight)
+        def submit(i, attempt=0, retry_after=None):
+            future = executor.submit(self.fetch_chunk, chunks[i], attempt, retry_after)
+            pending[future] = (i, attempt)
+
+        try:
+            while next_chunk < len(chunks) or pending:
+                while next_chunk < len(chunks) and len(pending) < self.max_in_flight:
+                    submit(next_chunk)
+                    next_chunk += 1
+                finished, _ = wait(pending, timeout=self.poll if self.interrupt else None,
+                                   return_when=FIRST_COMPLETED)
+                if self.interrupt:
+                    self.interrupt()
+                for future in finished:
+                    i, attempt = pending.pop(future)
+                    try:
+                        items = future.result()
+                        self.bucket.speed_up()
+                    except Throttled as e:
+                        self.throttled += 1
+                        self.bucket.slow_down()
+                        if attempt >= self.max_retries:
+                            raise RuntimeError(
+                                f"BGG kept throttling ids {chunks[i]}, giving up") from e
+                        submit(i, attempt + 1, e.retry_after)
+                        continue
+                    yield i, items
+        finally:
+            for future in pending:
+                future.cancel()
+            # requests still running are not waited for
+            executor.shutdown(wait=False)
+
+    def games(self, game_ids):
+        """
+        Yields the games for game_ids, in order, as soon as each is available.
+        """
+        from boardgamegeek.loaders import create_game_from_xml
+        cached = {}
+        missing = []
+        for game_id in dict.fromkeys(game_ids):
+            xml, state = (self.cache.get(game_id) if self.cache and not self.refresh
+                          else (None, None))
+            if xml is None:
+                missing.append(game_id)
+            else:
+                cached[game_id] = xml
+                if state != FRESH:
+                    self.stale_ids.append(game_id)
+        chunks = [missing[n:n + self.chunk_size]
+                  for n in range(0, len(missing), self.chunk_size)]
+        chunk_of = {game_id: n // self.chunk_size for n, game_id in enumerate(missing)}
+        # fetched chunks are dropped once all their games have been yielded
+        remaining = collections.Counter(chunk_of[game_id] for game_id in game_ids
+                                        if game_id not in cached)
+        fetched = {}
+        completed = self.fetch_chunks(chunks)
+        for game_id in game_ids:
+            if game_id in cached:
+                item = xmlET.fromstring(cached[game_id])
+            else:
+                i = chunk_of[game_id]
+                while i not in fetched:
+                    done, items = next(completed)
+                    fetched[done] = items
+                item = fetched[i].get(game_id)
+                remaining[i] -= 1
+                if not remaining[i]:
+                    del fetched[i]
+                if item is None:
+                    LOGGER.warning(f"BGG returned nothing for game {game_id}, skipping it")
+                    continue
+            yield create_game_from_xml(item, game_id=game_id)
+        completed.close()
+        LOGGER.debug(f"Fetched {len(missing)} games in {self.requests} requests "
+                     f"({self.throttled} throttled)")
+
+    def revalidate(self):
+        """
+        Starts fetching the stale games served from the cache by games(), in a
+        background thread, so that the next run finds them fresh. Returns the thread.
+        """
+        stale_ids = self.stale_ids
+        self.stale_ids = []
+        chunks = [stale_ids[n:n + self.chunk_size]
+                  for n in range(0, len(stale_ids), self.chunk_size)]
+        def fetch():
+            for _ in self.fetch_chunks(chunks):
+                pass
+        thread = threading.Thread(target=fetch, daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,116 @@
+"""
+Cache of BGG game details, one row per game.
+
+BGG returns a game's static details (names, player counts, categories) and its
+volatile statistics (rank, weight, player count poll) in the same <item>, so the
+cache keeps the item with the time it was fetched and judges its age against two
+TTLs: younger than stats_ttl it is fresh; between stats_ttl and details_ttl it is
+served as is but should be revalidated (stale-while-revalidate); older, it has to
+be fetched again before use. The database is size bounded, evicting the least
+recently used games, and in WAL mode so that several runs can read it at once.
+Collections fetched by a FetchScheduler are kept too, for a single TTL.
+"""
+import json
+import time
+import sqlite3
+import threading
+
+FRESH = 'fresh'
+STALE = 'stale'
+
+class GameCache:
+    def __init__(self, path, details_ttl=30 * 24 * 3600, stats_ttl=24 * 3600,
+                 max_size=512 * 2**20):
+        self.details_ttl = details_ttl
+        self.stats_ttl = stats_ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS items (
+                id INTEGER PRIMARY KEY,
+                xml BLOB NOT NULL,
+                fetched REAL NOT NULL,
+                used REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS items_used ON items (used);
+            CREATE TABLE IF NOT EXISTS collections (
+                username TEXT PRIMARY KEY,
+                items TEXT NOT NULL,
+                fetched REAL NOT NULL);
+        ''')
+        self.used = []
+        self.hits = 0
+        self.stale = 0
+        self.misses = 0
+
+    def get(self, game_id):
+        """
+        Returns (xml, FRESH or STALE) for a cached game, or (None, None).
+        """
+        with self.lock:
+            row = self.db.execute('SELECT xml, fetched FROM items WHERE id = ?',
+                                  (game_id,)).fetchone()
+            age = time.time() - row[1] if row else None
+            if row is None or age >= self.details_ttl:
+                self.misses += 1
+                return None, None
+            self.used.append(game_id)
+            if age < self.stats_ttl:
+                self.hits += 1
+                return row[0], FRESH
+            self.stale += 1
+            return row[0], STALE
+
+    def put(self, items):
+        """
+        Stores (game id, xml) pairs.
+        """
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO items (id, xml, fetched, used) VALUES (?, ?, ?, ?)',
+                ((game_id, xml, now, now) for game_id, xml in items))
+
+    def get_collection(self, username, ttl):
+        """
+        Returns the (game id, last_modified) pairs of a collection fetched less than
+        ttl seconds ago, or None.
+        """
+        with self.lock:
+            row = self.db.execute('SELECT items, fetched FROM collections WHERE username = ?',
+                                  (username,)).fetchone()
+        if row is None or time.time() - row[1] >= ttl:
+            return None
+        return [tuple(item) for item in json.loads(row[0])]
+
+    def put_collection(self, username, items):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO collections VALUES (?, ?, ?)',
+                            (username, json.dumps(items), time.time()))
+
+    def flush(self):
+        """
+        Records the uses of cached games and evicts the least recently used ones
+        beyond max_size.
+        """
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany('UPDATE items SET used = ? WHERE id = ?',
+                                ((now, game_id) for game_id in self.used))
+            self.used = []
+            total = self.db.execute(
+                'SELECT COALESCE(SUM(LENGTH(xml)), 0) FROM items').fetchone()[0]
+            if total <= self.max_size:
+                return
+            evict = []
+            for game_id, size in self.db.execute(
+                    'SELECT id, LENGTH(xml) FROM items ORDER BY used'):
+                if total <= self.max_size:
+                    break
+                evict.append((game_id,))
+                total -= size
+            self.db.executemany('DELETE FROM items WHERE id = ?', evict)
+
+    def stats(self):
+        return {'hits': self.hits, 'stale': self.stale, 'misses': self.misses}
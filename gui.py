@@ -1,55 +1,152 @@
+import io
+import time
+import queue
+import logging
 import traceback
 import tkinter as tk
 import calendar
 import datetime
+from collections import OrderedDict
 from tkinter import ttk, font, filedialog
 from tkinter.scrolledtext import ScrolledText
-from threading import Thread
+from threading import Thread, Event
 import bgg_labeler
 from types import SimpleNamespace
 import boardgamegeek as bgg
 
+LOGGER = logging.getLogger('main')
+
+# how often the window looks at the events of the run, and how many it handles at once
+POLL_INTERVAL = 100 # ms
+POLL_EVENTS = 500
+THUMBNAILS = 6
+THUMBNAIL_SIZE = (150, 100) # px
+
 class ProcessManager():
-    current_stage = 'downloading_collection'
-    current_item = 'Azul'
-    step = 23
-    total = 251
+    """
+    Shows the progress of a run: the count, rate and time left of every stage in the
+    label, and the last stage with a total (the one furthest along) in the bar.
+    """
+    STAGES = {'collection': "Games to print",
+              'fetch': "Games fetched",
+              'render': "Labels rendered",
+              'pages': "Pages laid out"}
 
     def __init__(self, pbar, label=None):
-        if type(pbar) == ttk.Progressbar:
-            self.tk_pbar = pbar
-        if label is not None:
-            self.tk_label = label
+        self.tk_pbar = pbar
+        self.tk_label = label
+        self.reset()
 
-    def reset(self, total):
+    def reset(self, total=0):
+        self.stages = {}
+        self.current_stage = None
+        self.current_item = None
         self.step = 0
-        self.total = 0
+        self.total = total
+        self.tk_pbar.configure(mode='determinate', maximum=max(total, 1), value=0)
 
     def set_current_item(self, item):
         self.current_item = item
-        if self.tk_label:
-            self.tk_label.configure(value=item)
-
-    def update(self, step=None):
-        delta = 1
-        if step:
-            delta = step - self.step
-            self.step = step
+        self.show()
+
+    def update(self, stage, step=None, total=None):
+        now = time.monotonic()
+        started, previous, _ = self.stages.get(stage, (now, 0, None))
+        self.stages[stage] = (started, previous + 1 if step is None else step, total)
+        order = list(self.STAGES)
+        if total and (self.current_stage is None
+                      or order.index(stage) >= order.index(self.current_stage)):
+            self.current_stage = stage
+            self.step = self.stages[stage][1]
+            self.total = total
+            self.tk_pbar.configure(maximum=max(total, 1), value=self.step)
+        self.show()
+
+    def show(self):
+        if self.tk_label is None:
+            return
+        now = time.monotonic()
+        lines = []
+        for stage, (started, step, total) in self.stages.items():
+            line = f"{self.STAGES.get(stage, stage)}: {step}"
+            if total:
+                line += f" / {total}"
+            elapsed = now - started
+            if total and step < total and elapsed > 1:
+                rate = step / elapsed
+                left = (total - step) / rate
+                line += f"  ({rate:.1f}/s, {datetime.timedelta(seconds=round(left))} left)"
+            lines.append(line)
+        if self.current_item:
+            lines.append(self.current_item)
+        self.tk_label.configure(text='\n'.join(lines))
+
+class Thumbnailer:
+    """
+    Makes small images of labels in a thread of its own, so that neither the run nor
+    the window waits for them, and puts them on `events` as ('thumbnail', key, image).
+    Labels are kept by key: an identical label is not rendered again. Labels arriving
+    faster than they can be rendered are skipped, only the last ones are shown anyway.
+    """
+    def __init__(self, events, size=THUMBNAIL_SIZE, cache_size=64):
+        self.events = events
+        self.size = size
+        self.labels = queue.Queue(maxsize=THUMBNAILS)
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.failed = False
+        Thread(target=self.loop, daemon=True).start()
+
+    def add(self, key, label):
+        if self.failed:
+            return
+        try:
+            self.labels.put_nowait((key, label))
+        except queue.Full:
+            pass
+
+    def render(self, label):
+        from PIL import Image
+        if isinstance(label, Image.Image):
+            image = label.copy()
         else:
-            self.step += 1
-        if self.tk_pbar:
-            self.tk_pbar.step(delta)
+            import raster
+            from svglib.svglib import svg2rlg
+            bgg_labeler.register_fonts()
+            drawing = svg2rlg(io.BytesIO(label) if isinstance(label, bytes) else str(label))
+            image = raster.rasterize(drawing, dpi=72)
+        image.thumbnail(self.size)
+        return image
+
+    def loop(self):
+        while True:
+            key, label = self.labels.get()
+            image = self.cache.get(key)
+            if image is None:
+                try:
+                    image = self.render(label)
+                except Exception as e:
+                    # e.g. no renderPM: the run goes on without thumbnails
+                    LOGGER.info(f"No label thumbnails: {e}")
+                    self.failed = True
+                    return
+                self.cache[key] = image
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            else:
+                self.cache.move_to_end(key)
+            self.events.put(('thumbnail', key, image))
 
 class BGGui(ttk.Frame):
     def error(self, error_short, error=''):
         if isinstance(error_short, Exception) and not error:
             error = traceback.format_exc()
-        self.w_progressbar.pack_forget()
-        self.w_force_stop.pack_forget()
+        self.hide_progress()
         self.w_error.config(text="Error: " + str(error_short))
         if error:
             self.w_error_label.pack()
             self.w_error_long.pack()
+            self.w_error_long.delete('1.0', tk.END)
             self.w_error_long.insert(tk.INSERT, error)
         else:
             self.w_error_label.pack_forget()
@@ -59,25 +156,92 @@ class BGGui(ttk.Frame):
         self.w_submit.pack()
 
     def do_compute(self):
+        # runs in its own thread: the window only hears of it through self.events
         try:
-            bgg_labeler.run(self.args_namespace)
-            self.complete()
-        except Exception as e :
-            self.error(e)
+            bgg_labeler.run(self.args_namespace, self.on_progress, self.cancel)
+            self.events.put(('done',))
+        except bgg_labeler.Cancelled:
+            self.events.put(('stopped',))
+        except Exception as e:
+            self.events.put(('error', e, traceback.format_exc()))
 
-    def complete(self):
+    def on_progress(self, stage, done, total, item):
+        # called from the thread of the run
+        self.events.put(('progress', stage, done, total,
+                         item.name if stage == 'fetch' else None))
+        if stage == 'render':
+            self.thumbnailer.add(*item)
+
+    def poll(self):
+        """
+        Handles the events of the run (a few at a time, so that the window stays
+        responsive), and looks again POLL_INTERVAL ms later.
+        """
+        for _ in range(POLL_EVENTS):
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            kind, *values = event
+            if kind == 'progress':
+                stage, done, total, name = values
+                self.progress.update(stage, done, total)
+                if name:
+                    self.progress.set_current_item(f"Fetched {name}")
+            elif kind == 'thumbnail':
+                self.show_thumbnail(*values)
+            elif kind == 'done':
+                self.complete()
+            elif kind == 'stopped':
+                self.stopped()
+            elif kind == 'error':
+                self.error(*values)
+        self.after(POLL_INTERVAL, self.poll)
+
+    def show_thumbnail(self, key, image):
+        from PIL import ImageTk
+        photo = self.photos.get(key)
+        if photo is None:
+            photo = self.photos[key] = ImageTk.PhotoImage(image)
+            if len(self.photos) > 4 * THUMBNAILS:
+                self.photos.popitem(last=False)
+        else:
+            self.photos.move_to_end(key)
+        # the newest label comes first
+        self.thumbnail_keys = ([key] + self.thumbnail_keys)[:THUMBNAILS]
+        for widget, shown in zip(self.w_thumbnails, self.thumbnail_keys):
+            widget.configure(image=self.photos[shown])
+        self.thumbnail_frame.pack()
+
+    def hide_progress(self):
         self.w_progressbar.pack_forget()
+        self.w_status.pack_forget()
         self.w_force_stop.pack_forget()
+
+    def complete(self):
+        self.hide_progress()
+        self.args_namespace.resume = False
+        self.w_success_label.config(text="Success!", foreground='green')
         self.w_success_label.pack()
-        
+        self.w_submit.pack()
+
+    def stopped(self):
+        self.hide_progress()
+        # the journal of the run is kept: starting again picks it up where it stopped
+        self.args_namespace.resume = True
+        self.w_success_label.config(text="Stopped, start again to continue",
+                                    foreground='')
+        self.w_success_label.pack()
+        self.w_submit.pack()
+
+    def force_stop(self):
+        self.cancel.set()
+        self.w_force_stop.config(state='disabled')
+        self.progress.set_current_item("Stopping...")
 
     def start(self):
         self.error_frame.pack_forget()
-        self.w_progressbar.pack()
-        self.w_progressbar.configure(length=self.w_progressbar.master.winfo_width())
-        self.w_progressbar.start()
-        self.w_submit.pack_forget()
-        self.w_force_stop.pack()
+        self.w_success_label.pack_forget()
         self.args_namespace.username = self.username.get()
         if not self.out_file.get():
             self.error("Need a valid output filename")
@@ -85,9 +249,9 @@ class BGGui(ttk.Frame):
         self.args_namespace.out_file = self.out_file.get()
         self.args_namespace.no_pdf = self.no_pdf.get()
         self.args_namespace.no_svg_pages = self.no_svg_pages.get()
-        self.args_namespace.since = self.since.get()
-        self.args_namespace.cols = int(self.cols.get())
+        self.args_namespace.columns = int(self.cols.get())
         self.args_namespace.rows = int(self.rows.get())
+        self.args_namespace.since = None
         if self.date_year.get() or self.date_month.get() or self.date_day.get():
             months = [calendar.month_name[i] for i in range(1, 13)]
             try:
@@ -95,12 +259,19 @@ class BGGui(ttk.Frame):
                 date = datetime.date(int(self.date_year.get()), 
                                      month_n, 
                                      int(self.date_day.get()))
-                self.args_namespace.date = date
+                self.args_namespace.since = date
             except:
                 self.error("Invalid date specified")
                 return
-            self.args_namespace.no_cache = True
-        self.t1 = Thread(target=self.do_compute)
+        self.w_submit.pack_forget()
+        self.progress.reset()
+        self.w_progressbar.pack()
+        self.w_progressbar.configure(length=self.w_progressbar.master.winfo_width())
+        self.w_status.pack()
+        self.w_force_stop.config(state='normal')
+        self.w_force_stop.pack()
+        self.cancel = Event()
+        self.t1 = Thread(target=self.do_compute, daemon=True)
         self.t1.start()
 
     def ask_save_name(self):
@@ -144,7 +315,7 @@ class BGGui(ttk.Frame):
         self.w_submit = ttk.Button(
             self.left_frame, text="Start", command=self.start)
         self.w_force_stop = ttk.Button(
-            self.left_frame, text="Force Stop")
+            self.left_frame, text="Force Stop", command=self.force_stop)
 
         self.error_frame = ttk.Frame(self.left_frame)
         self.w_error = ttk.Label(
@@ -159,7 +330,19 @@ class BGGui(ttk.Frame):
 
         self.w_success_label = ttk.Label(
             self.left_frame, text="Success!", foreground='green')
-        self.w_progressbar = ttk.Progressbar(self.left_frame, mode="indeterminate")
+        self.w_progressbar = ttk.Progressbar(self.left_frame, mode="determinate")
+        self.w_status = ttk.Label(self.left_frame, justify='left')
+        self.progress = ProcessManager(self.w_progressbar, self.w_status)
+        self.thumbnail_frame = ttk.Frame(self.left_frame)
+        self.w_thumbnails = [ttk.Label(self.thumbnail_frame) for _ in range(THUMBNAILS)]
+        for i, widget in enumerate(self.w_thumbnails):
+            widget.grid(row=i // 3, column=i % 3, padx=2, pady=2)
+        self.thumbnail_keys = []
+        self.photos = OrderedDict()
+        self.events = queue.Queue()
+        self.cancel = Event()
+        self.thumbnailer = Thumbnailer(self.events)
+        self.after(POLL_INTERVAL, self.poll)
 
         self.w_user_label.pack(side='left')
         self.w_user_entry.pack(side='right')
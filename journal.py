@@ -0,0 +1,172 @@
+"""
+Journal of a run, to pick it up where it stopped.
+
+A run that dies halfway (the network drops, a game cannot be labeled, the GUI is
+stopped) would otherwise start again from the collection. The journal keeps what each
+stage finished, as it finishes it: the game ids of the run, the label records of the
+games fetched (in chunks), the labels rendered (in its own label directory, when the
+label cache is off) and the PDF drawn so far (in segments of pages). `--resume` reuses
+all of it that still applies, and only does the rest.
+
+Every file is written to a temporary file first and renamed, so that a run stopped at
+any point leaves either the previous version of a file or the new one, never half of
+it. Games that cannot be labeled are quarantined: listed in the journal and skipped,
+instead of ending the run.
+"""
+import os
+import json
+import time
+import shutil
+import logging
+from pathlib import Path
+from records import save_records, load_records
+
+LOGGER = logging.getLogger('main')
+
+def atomic_write(path, data):
+    """
+    Writes data (bytes or str) to path through a temporary file renamed over it.
+    """
+    path = Path(path)
+    tmp_path = path.with_suffix(f'{path.suffix}.{os.getpid()}.tmp')
+    with open(tmp_path, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+class RunJournal:
+    def __init__(self, directory, chunk_size=100):
+        self.directory = Path(directory)
+        self.label_dir = self.directory / 'labels'
+        self.chunk_size = chunk_size
+        self.run = {}
+        self.chunks = 0
+        self.pending = []
+        self.quarantined = []
+
+    def start(self, resume=False):
+        """
+        Starts a new journal, or with resume continues the last one if there is one.
+        Returns whether it did.
+        """
+        try:
+            with open(self.directory / 'run.json') as f:
+                run = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            run = None
+        if resume and run is None:
+            print("No unfinished run to resume, starting over")
+        if resume and run is not None:
+            self.run = run
+            self.chunks = len(list(self.directory.glob('records-*.json')))
+            # quarantined games are given another chance
+            print(f"Resuming the run started {time.ctime(run['started'])}")
+            return True
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.label_dir)
+        self.run = {'started': time.time()}
+        self.save_run()
+        return False
+
+    def save_run(self):
+        atomic_write(self.directory / 'run.json', json.dumps(self.run))
+
+    def get(self, key, default=None):
+        return self.run.get(key, default)
+
+    def set(self, key, value):
+        """
+        Records something about the run (e.g. its game ids) for a resumed run.
+        """
+        self.run[key] = value
+        self.save_run()
+
+    def records(self):
+        """
+        Returns the label records saved so far, by game id.
+        """
+        records = {}
+        for path in sorted(self.directory.glob('records-*.json')):
+            for record in load_records(path):
+                records[record.id] = record
+        return records
+
+    def add_record(self, record):
+        self.pending.append(record)
+        if len(self.pending) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Saves the records added since the last flush, as one more chunk.
+        """
+        if not self.pending:
+            return
+        path = self.directory / f'records-{self.chunks:05d}.json'
+        tmp_path = path.with_suffix('.tmp')
+        save_records(self.pending, tmp_path)
+        os.replace(tmp_path, path)
+        self.chunks += 1
+        self.pending = []
+
+    def quarantine(self, game, error):
+        """
+        Records that a game could not be labeled, and why (error names the game).
+        """
+        LOGGER.warning(f"{error}, skipping it")
+        self.quarantined = [entry for entry in self.quarantined if entry['id'] != game.id]
+        self.quarantined.append({'id': game.id, 'name': game.name, 'error': str(error)})
+        atomic_write(self.directory / 'quarantine.json', json.dumps(self.quarantined))
+
+    def segment_path(self, n, output=None):
+        if output is None:
+            return self.directory / f'segment-{n:05d}.pdf'
+        return self.directory / f'output-{output}-segment-{n:05d}.pdf'
+
+    def segments(self, output=None):
+        if output is None:
+            return self.run.setdefault('segments', {})
+        return self.run.setdefault('outputs', {}).setdefault(str(output), {})
+
+    def segment(self, n, cols, pages, output=None):
+        """
+        Returns segment n of the PDF (of another output of the run, if given) if it was
+        drawn with these pages (lists of label keys) and columns, else None.
+        """
+        if self.segments(output).get(str(n)) != {'cols': cols, 'pages': pages}:
+            return None
+        try:
+            with open(self.segment_path(n, output), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def save_segment(self, n, cols, pages, pdf, output=None):
+        atomic_write(self.segment_path(n, output), pdf)
+        self.segments(output)[str(n)] = {'cols': cols, 'pages': pages}
+        self.save_run()
+
+    def output(self, output):
+        """
+        The segments of another output of the run (e.g. its number), for draw_segments.
+        """
+        return OutputJournal(self, output)
+
+    def finish(self):
+        """
+        Deletes the journal of a run that completed.
+        """
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+class OutputJournal:
+    """
+    The segment() and save_segment() of a RunJournal, for one of the outputs of a run.
+    """
+    def __init__(self, journal, output):
+        self.journal = journal
+        self.output = output
+
+    def segment(self, n, cols, pages):
+        return self.journal.segment(n, cols, pages, self.output)
+
+    def save_segment(self, n, cols, pages, pdf):
+        self.journal.save_segment(n, cols, pages, pdf, self.output)
@@ -1,9 +1,16 @@
 #!/usr/bin/env python
 import sys
+from pathlib import Path
 from datetime import datetime
 import argparse
-from gui import main as start_gui
-from bgg_labeler import run
+import multiprocessing
+from bgg_labeler import (run, run_batch, snapshot_command, merge_command, LABEL_CACHE_SIZE,
+                         SVG_TEMPLATE)
+
+def start_gui(args):
+    # tkinter is only imported when the GUI is actually used
+    from gui import main
+    main(args)
 
 class GuiAction(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
@@ -20,14 +27,74 @@ def main():
                         help="BGG username whose collection to get",
                         nargs='?')
     parser.add_argument('--gui', action=GuiAction, nargs=0)
-    parser.add_argument('-c', '--columns', default=3)
-    parser.add_argument('-r', '--rows', default=6)
+    parser.add_argument('--users', nargs='+', metavar='USERNAME',
+                        help="Print the collections of several users, fetching shared games once")
+    parser.add_argument('--job-file', metavar='FILE',
+                        help="Like --users, reading one 'username [output.pdf]' per line from FILE")
+    parser.add_argument('--combined', action="store_true",
+                        help="With --users/--job-file, write one PDF for all users "
+                             "instead of OUT-username.pdf for each")
+    parser.add_argument('--serve', action="store_true",
+                        help="Keep running and render labels for requests on a local HTTP API")
+    parser.add_argument('--host', default='127.0.0.1', help="Address to serve on")
+    parser.add_argument('--port', type=int, default=8035, help="Port to serve on")
+    parser.add_argument('--bgg-api', default=None, metavar='URL',
+                        help="BGG XML API the server uses, e.g. a local stand-in for testing")
+    parser.add_argument('-c', '--columns', type=int, default=3)
+    parser.add_argument('-r', '--rows', type=int, default=6)
     parser.add_argument('-o', '--out', default="labels.pdf", dest='out_file')
-    parser.add_argument('--no-cache', dest="cache", action="store_false")
+    parser.add_argument('--no-cache', dest="cache", action="store_false",
+                        help="Render every label and page again instead of reusing unchanged ones")
+    parser.add_argument('--cache-size', type=int, default=LABEL_CACHE_SIZE, metavar='MB',
+                        help="Maximum size of the rendered label cache")
     parser.add_argument('--no-pdf', action="store_false",
                         help="Do not produce a final PDF, just SVG pages")
     parser.add_argument('--no-svg-pages', action="store_false",
                         help="Do not output a PDF or SVG pages, just labels")
+    parser.add_argument('--via-svg-pages', action="store_true",
+                        help="Build the PDF from intermediate SVG and PDF pages (kept for debugging)")
+    parser.add_argument('--resume', action="store_true",
+                        help="Continue the last run that did not finish, reusing the "
+                        "games it fetched, the labels it rendered and the pages it drew")
+    parser.add_argument('--sync', action="store_true",
+                        help="Only print labels for games added or modified since the last --sync")
+    parser.add_argument('--refresh', action="store_true",
+                        help="Fetch every game from BGG again instead of using cached game data")
+    parser.add_argument('--layout', choices=['collection', 'append'], default='collection',
+                        help="'append' keeps the pages of the previous PDF as they were and "
+                             "puts new or changed labels on new pages")
+    parser.add_argument('--output', nargs=4, action='append', dest='outputs',
+                        metavar=('TEMPLATE', 'ROWS', 'COLUMNS', 'FILE'),
+                        help="Write a PDF of labels made with TEMPLATE ('-' for the default "
+                             "one), ROWS x COLUMNS per page, to FILE. Repeat for several "
+                             "outputs from one run; -o, -r and -c are then ignored")
+    parser.add_argument('--shard', metavar='i/N',
+                        help="Only print shard i of N of the labels, to a directory next to "
+                             "the output that --merge puts together with the other shards")
+    parser.add_argument('--merge', nargs='+', metavar='DIR',
+                        help="Write the PDF of a sharded run from the directories of its shards")
+    parser.add_argument('--png', metavar='DIR',
+                        help="Write labels as PNG images to DIR instead of a PDF")
+    parser.add_argument('--png-sheets', action="store_true",
+                        help="With --png, write one image per sheet of rows x columns labels")
+    parser.add_argument('--dpi', type=int, default=300,
+                        help="Resolution of --png images (default: 300)")
+    parser.add_argument('--debug-dir', metavar='DIR',
+                        help="Also write every label SVG and the page layout to DIR")
+    parser.add_argument('--offline', action="store_true",
+                        help="Use the collection and games saved by earlier runs instead of BGG")
+    parser.add_argument('--export-snapshot', metavar='FILE',
+                        help="Write the saved collections and games to FILE and exit")
+    parser.add_argument('--import-snapshot', metavar='FILE',
+                        help="Load collections and games from FILE and exit")
+    parser.add_argument('--profile', action="store_true",
+                        help="Log time, items and memory spent in each stage")
+    parser.add_argument('--trace', metavar='FILE',
+                        help="Write stage timings as a Chrome trace (JSON)")
+    parser.add_argument('--cprofile', metavar='STAGE',
+                        choices=['collection', 'fetch', 'render', 'pdf',
+                                 'compose', 'export', 'join', 'png', 'cache', 'revalidate'],
+                        help="Run STAGE under cProfile and dump the stats to STAGE.prof")
     parser.add_argument('--since',
                         metavar='date',
                         type=lambda x: datetime.fromisoformat(x).date(),
@@ -35,11 +102,56 @@ def main():
     parser.add_argument('--bgg-id',
                         type=int,
                         help="Generate label only for this ID")
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        help="Number of processes generating labels and drawing pages "
+                             "(default: one per core)")
+    parser.add_argument('--chunk-size', type=int, default=20,
+                        help="Number of games requested from BGG at once")
+    parser.add_argument('--max-requests', type=int, default=4,
+                        help="Maximum number of BGG requests in flight")
+    parser.add_argument('--requests-per-second', type=float, default=0.5,
+                        help="Budget of BGG requests per second (lowered automatically when throttled)")
     args = parser.parse_args()
-    if args.username:
+    if args.sync and (args.offline or args.bgg_id):
+        parser.error("--sync cannot be combined with --offline or --bgg-id")
+    if args.outputs:
+        if args.via_svg_pages or args.png or args.shard or args.layout != 'collection':
+            parser.error("--output cannot be combined with --via-svg-pages, --png, "
+                         "--shard or --layout append")
+        try:
+            args.outputs = [(SVG_TEMPLATE if template == '-' else Path(template),
+                             int(rows), int(cols), out_file)
+                            for template, rows, cols, out_file in args.outputs]
+        except ValueError:
+            parser.error("--output expects TEMPLATE ROWS COLUMNS FILE, e.g. - 6 3 labels.pdf")
+    if args.shard:
+        if args.via_svg_pages or args.png or args.layout != 'collection':
+            parser.error("--shard cannot be combined with --via-svg-pages, --png or --layout append")
+        from shards import parse_shard
+        try:
+            args.shard = parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.serve:
+        from server import serve
+        kwargs = {'api_endpoint': args.bgg_api} if args.bgg_api else {}
+        serve(args.host, args.port,
+              requests_per_second=args.requests_per_second,
+              max_requests=args.max_requests,
+              chunk_size=args.chunk_size,
+              **kwargs)
+    elif args.export_snapshot or args.import_snapshot:
+        snapshot_command(args)
+    elif args.merge:
+        merge_command(args)
+    elif args.users or args.job_file:
+        run_batch(args)
+    elif args.username:
         run(args)
     else:
         start_gui(args)
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     main()
@@ -0,0 +1,177 @@
+"""
+Label records: what a game's label shows, and nothing else.
+
+Labels used to be filled from a boardgamegeek BoardGame, going through its data, its
+rank objects and every entry of its player count poll each time one was rendered. A
+LabelRecord is worked out once from the game's data (the dict BoardGame.data()
+returns, which is also what the snapshot stores), holds a few short strings and
+numbers, and pickles to a plain tuple for worker processes. Many records are saved
+and loaded as columns with save_records() and load_records().
+"""
+import json
+import bisect
+
+COLOR_GREEN = '#008000'
+COLOR_YELLOW = '#ca9a08'
+COLOR_ORANGE = '#e27a07'
+COLOR_RED = '#bb0707'
+
+NOT_RECOMMENDED_TRESHOLD = 0.7
+
+# upper bounds (included) of the weight classes, and the name and colour of each class
+WEIGHT_BOUNDS = (2, 2.8, 3.2, 3.7, 4)
+WEIGHT_CLASSES = (('Very Light', COLOR_GREEN),
+                  ('Light', COLOR_GREEN),
+                  ('Medium-Light', COLOR_YELLOW),
+                  ('Medium', COLOR_ORANGE),
+                  ('Medium-Heavy', COLOR_ORANGE),
+                  ('Heavy', COLOR_RED))
+# ranks make a "Top n" award for the smallest n they are within
+RANK_CUTOFFS = (1, 5, 10, 20, 50, 100, 200, 1000)
+
+FIELDS = ('id', 'name', 'weight_label', 'weight_color', 'player_range', 'time_range',
+          'rating', 'award', 'tags', 'not_recommended_str')
+# columns saved as indices into a list of their distinct values
+DICTIONARY_FIELDS = ('weight_color', 'award', 'tags')
+RECORDS_VERSION = 1
+
+class LabelRecord:
+    """
+    The values printed on the label of a game. get() reads them like the game_info
+    dicts the label template used to be filled with.
+    """
+    __slots__ = FIELDS
+
+    def __init__(self, id, name, weight_label, weight_color, player_range, time_range,
+                 rating, award=None, tags=(), not_recommended_str=None):
+        self.id = id
+        self.name = name
+        self.weight_label = weight_label
+        self.weight_color = weight_color
+        # a number, or a "min - max" string
+        self.player_range = player_range
+        self.time_range = time_range
+        self.rating = rating
+        self.award = award
+        self.tags = tuple(tags)
+        self.not_recommended_str = not_recommended_str
+
+    @classmethod
+    def from_data(cls, data):
+        """
+        Builds the record of a game from its BoardGame.data().
+        """
+        stats = data['stats']
+        weight = stats['averageweight']
+        weight_name, weight_color = WEIGHT_CLASSES[bisect.bisect_left(WEIGHT_BOUNDS, weight)]
+        minplayers = data['minplayers']
+        maxplayers = data['maxplayers']
+        mintime = data.get('minplaytime')
+        maxtime = data.get('maxplaytime')
+        return cls(data.get('id'), data.get('name'),
+                   f'{weight_name} ({weight:.1f})', weight_color,
+                   minplayers if minplayers == maxplayers else f"{minplayers} - {maxplayers}",
+                   f"{mintime} min" if mintime == maxtime else f"{mintime} - {maxtime} min",
+                   stats['average'],
+                   award(stats.get('ranks') or ()),
+                   data.get('categories') or (),
+                   not_recommended(data, minplayers, maxplayers))
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def values(self):
+        return tuple(getattr(self, field) for field in FIELDS)
+
+    def __reduce__(self):
+        return LabelRecord, self.values()
+
+    def __eq__(self, other):
+        return isinstance(other, LabelRecord) and self.values() == other.values()
+
+    def __repr__(self):
+        return f"LabelRecord(id={self.id!r}, name={self.name!r})"
+
+def award(ranks):
+    """
+    Returns the award of the best of ranks (dicts with a name and a value, None if
+    unranked), e.g. "Top 100 strategy", or None if no rank is good enough.
+    """
+    best = min((rank for rank in ranks if rank.get('value') is not None),
+               key=lambda rank: rank['value'], default=None)
+    if best is None:
+        return None
+    cutoff = bisect.bisect_left(RANK_CUTOFFS, best['value'])
+    if cutoff == len(RANK_CUTOFFS):
+        return None
+    name = best['name'].replace('games', '').replace('boardgame', 'all time')
+    return f"Top {RANK_CUTOFFS[cutoff]} {name}"
+
+def not_recommended(data, minplayers, maxplayers):
+    """
+    Returns the player counts (between minplayers and maxplayers) that most voters
+    do not recommend, as ranges, e.g. "1,4-5", or None.
+    """
+    counts = []
+    results = (data.get('suggested_players') or {}).get('results') or {}
+    for count, votes in results.items():
+        n = int(count[:-1]) + 1 if count.endswith('+') else int(count)
+        total = votes['best_rating'] + votes['recommended_rating'] + votes['not_recommended_rating']
+        if (total and NOT_RECOMMENDED_TRESHOLD < votes['not_recommended_rating'] / total
+                and minplayers <= n <= maxplayers):
+            counts.append(n)
+    if not counts:
+        return None
+    counts.sort()
+    ranges = [[counts[0], counts[0]]]
+    for n in counts[1:]:
+        if n == ranges[-1][1] + 1:
+            ranges[-1][1] = n
+        else:
+            ranges.append([n, n])
+    return ','.join(f'{low}' if low == high else f'{low}-{high}' for low, high in ranges)
+
+def build_records(datas):
+    """
+    Builds the records of many games from their data (any iterable), in order.
+    """
+    from_data = LabelRecord.from_data
+    return [from_data(data) for data in datas]
+
+def save_records(records, file):
+    """
+    Writes records to file, one JSON list per field. Values that repeat a lot (weight
+    colours, awards, tags) are written once and referred to by index.
+    """
+    columns = {field: [] for field in FIELDS}
+    dictionaries = {field: {} for field in DICTIONARY_FIELDS}
+    def index(field, value):
+        return dictionaries[field].setdefault(value, len(dictionaries[field]))
+    for record in records:
+        for field, value in zip(FIELDS, record.values()):
+            if field == 'tags':
+                value = [index(field, tag) for tag in value]
+            elif field in dictionaries:
+                value = index(field, value)
+            columns[field].append(value)
+    with open(file, 'w') as f:
+        json.dump({'version': RECORDS_VERSION,
+                   'dictionaries': {field: list(values)
+                                    for field, values in dictionaries.items()},
+                   'columns': columns}, f, separators=(',', ':'))
+
+def load_records(file):
+    """
+    Reads the records written by save_records().
+    """
+    with open(file) as f:
+        saved = json.load(f)
+    if saved.get('version') != RECORDS_VERSION:
+        raise ValueError(f"{file} was written by another version of the labeler")
+    columns = saved['columns']
+    for field, values in saved['dictionaries'].items():
+        if field == 'tags':
+            columns[field] = [tuple(values[i] for i in tags) for tags in columns[field]]
+        else:
+            columns[field] = [values[i] for i in columns[field]]
+    return list(map(LabelRecord, *(columns[field] for field in FIELDS)))
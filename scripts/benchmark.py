@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+"""
+Offline benchmark of the labeler's stages.
+
+Games are synthetic boardgamegeek BoardGame objects (with ranks, categories and
+player count polls), and the fetch stage gets them from the stand-in BGG API of
+fake_bgg.py, so nothing touches the network. Each collection size runs in its own process, so that
+the peak RSS reported for it is not inflated by earlier sizes.
+
+    $ python scripts/benchmark.py --sizes 100 1000 --save baseline.json
+    $ python scripts/benchmark.py --sizes 100 1000 --baseline baseline.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+WORDS = ("the of lost ancient kingdom dragon castle war star empire trains river "
+         "cards dice quest island galaxy merchants tower shadow").split()
+CATEGORIES = ["Card Game", "Fantasy", "Economic", "Wargame", "Science Fiction",
+              "Adventure", "Exploration", "Civilization", "Territory Building",
+              "Medieval", "Negotiation", "Bluffing", "Dice", "Animals"]
+RANK_FAMILIES = ['strategygames', 'familygames', 'partygames', 'thematic']
+
+def fake_game_data(game_id):
+    """
+    Data for a boardgamegeek BoardGame, shaped like what the XML API loader produces.
+    """
+    rng = random.Random(game_id)
+    minplayers = rng.randint(1, 3)
+    maxplayers = minplayers + rng.randint(0, 4)
+    mintime = rng.choice([15, 30, 45, 60, 90, 120])
+    maxtime = mintime + rng.choice([0, 0, 30, 60])
+    results = {}
+    for n in range(1, maxplayers + 2):
+        count = str(n) if n <= maxplayers else f"{maxplayers}+"
+        results[count] = {'best_rating': rng.randint(0, 50),
+                          'recommended_rating': rng.randint(0, 80),
+                          'not_recommended_rating': rng.randint(0, 300)}
+    ranks = [{'type': 'subtype', 'id': 1, 'name': 'boardgame',
+              'friendlyname': 'Board Game Rank', 'value': rng.randint(1, 20000),
+              'bayesaverage': 6.5},
+             {'type': 'family', 'id': 5497, 'name': rng.choice(RANK_FAMILIES),
+              'friendlyname': 'Family Rank', 'value': rng.randint(1, 3000),
+              'bayesaverage': 6.5}]
+    return {'id': game_id,
+            'name': ' '.join(rng.choice(WORDS).capitalize()
+                             for _ in range(rng.randint(1, 9))),
+            'yearpublished': rng.randint(1980, 2023),
+            'minplayers': minplayers,
+            'maxplayers': maxplayers,
+            'minplaytime': mintime,
+            'maxplaytime': maxtime,
+            'playingtime': maxtime,
+            'categories': rng.sample(CATEGORIES, rng.randint(0, 6)),
+            'stats': {'average': rng.uniform(5, 9),
+                      'averageweight': rng.uniform(1, 5),
+                      'ranks': ranks},
+            'suggested_players': {'results': results}}
+
+def fake_games(n):
+    from boardgamegeek.objects.games import BoardGame
+    return [BoardGame(fake_game_data(i)) for i in range(1, n + 1)]
+
+def fetch_games(n):
+    """
+    Fetches games 1 to n from a local fake_bgg server, with no rate limit.
+    """
+    import requests
+    import fake_bgg
+    from fetcher import FetchScheduler
+    server = fake_bgg.start()
+    try:
+        with requests.Session() as session:
+            scheduler = FetchScheduler(session, api_endpoint=server.url,
+                                       requests_per_second=1e6)
+            return list(scheduler.games(list(range(1, n + 1))))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def check_drawing():
+    """
+    Draws labels through a DrawingCache smaller than the labels it is shared by, the
+    way batch jobs and several --output do: a single label, the same label several
+    times, and each twice, so that the second document draws from the cache.
+    """
+    import bgg_labeler as bl
+    label = bl.render_label(fake_games(1)[0])
+    for n in (1, 3):
+        drawing_cache = bl.DrawingCache(size=1)
+        for _ in range(2):
+            pdf, pages = bl.draw_pages(bl.paginate([label] * n, 6, 3), 3,
+                                       drawing_cache=drawing_cache)
+            assert pages == [[label[0]] * n] and pdf.startswith(b'%PDF'), pages
+    print("  draw_pages with a shared DrawingCache: ok")
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+def timed(results, stage, unit, n, function):
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    value = function()
+    wall = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+    results[stage] = {'items': n,
+                      'unit': unit,
+                      'seconds': round(wall, 4),
+                      'cpu_seconds': round(cpu, 4),
+                      'per_second': round(n / wall, 2) if wall else None,
+                      'peak_rss_mb': peak_rss_mb()}
+    print(f"  {stage:14} {n:6} {unit:7} {wall:8.2f}s  {results[stage]['per_second']:9} {unit}/s")
+    return value
+
+def bench_size(n, rows, cols, svg_pages):
+    import bgg_labeler as bl
+    with tempfile.TemporaryDirectory(prefix='bgglabeler-bench-') as tmp:
+        workdir = Path(tmp)
+        bl.BUILDDIR = workdir
+        bl.LABELDIR = workdir / 'labels'
+        os.makedirs(bl.LABELDIR)
+        os.makedirs(workdir / 'pages')
+        results = {}
+        games = fake_games(n)
+        pages = -(-n // (rows * cols))
+        timed(results, 'fetch', 'labels', n, lambda: fetch_games(n))
+        infos = timed(results, 'game_info', 'labels', n,
+                      lambda: [bl.game_info(g) for g in games])
+        timed(results, 'fill_template', 'labels', n,
+              lambda: [bl.fill_template(info) for info in infos])
+        svg_paths = timed(results, 'write_svg', 'labels', n,
+                          lambda: [bl.write_svg(g, use_cache=False) for g in games])
+        timed(results, 'write_pdf', 'pages', pages,
+              lambda: bl.write_pdf(svg_paths, rows, cols, workdir / 'labels.pdf'))
+        timed(results, 'render_labels', 'labels', n,
+              lambda: bl.render_labels(games, rows, cols, jobs=1))
+        if svg_pages:
+            svg_pages = timed(results, 'compose_all', 'pages', pages,
+                              lambda: bl.compose_all(svg_paths, rows, cols))
+            pdf_pages = timed(results, 'export', 'pages', pages,
+                              lambda: bl.export(svg_pages))
+            timed(results, 'join_pdf', 'pages', pages,
+                  lambda: bl.join_pdf(pdf_pages, workdir / 'labels-joined.pdf'))
+        return results
+
+def startup_time(command, repeat=3):
+    """
+    Best of `repeat` wall times of a fresh interpreter running command.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + command, cwd=ROOT_DIR, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return round(min(times), 4)
+
+def bench_startup(budget):
+    """
+    Times `main.py --help` and a bare `import bgg_labeler`, and returns the ones that
+    take longer than budget seconds.
+    """
+    results = {'help': startup_time(['main.py', '--help']),
+               'import': startup_time(['-c', 'import bgg_labeler'])}
+    print("startup")
+    over = []
+    for name, seconds in results.items():
+        print(f"  {name:14} {seconds:8.2f}s")
+        if seconds > budget:
+            over.append(f"{name} took {seconds:.2f}s, budget is {budget:.2f}s")
+    return results, over
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for size, stages in results.items():
+        if size == 'startup':
+            continue
+        for stage, result in stages.items():
+            old = baseline.get(size, {}).get(stage)
+            if not old or not old.get('per_second') or not result['per_second']:
+                continue
+            change = result['per_second'] / old['per_second'] - 1
+            print(f"  {size:>6} {stage:14} {change:+7.1%}")
+            if change < -tolerance:
+                regressions.append(f"{stage} at {size} games: "
+                                   f"{old['per_second']} -> {result['per_second']} "
+                                   f"{result['unit']}/s")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the labeler offline")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('-r', '--rows', type=int, default=6)
+    parser.add_argument('-c', '--columns', type=int, default=3)
+    parser.add_argument('--no-svg-pages', dest='svg_pages', action='store_false',
+                        help="Skip the compose_all/export/join_pdf stages")
+    parser.add_argument('--save', metavar='FILE', help="Write results to a JSON file")
+    parser.add_argument('--baseline', metavar='FILE',
+                        help="Compare against results saved with --save")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Slowdown (fraction) tolerated before failing")
+    parser.add_argument('--startup-budget', type=float, default=0.5, metavar='SECONDS',
+                        help="Fail if `main.py --help` or importing bgg_labeler takes longer")
+    args = parser.parse_args()
+
+    results = {}
+    results['startup'], failures = bench_startup(args.startup_budget)
+    with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+        print("checks")
+        pool.apply(check_drawing)
+        for n in args.sizes:
+            print(f"{n} games")
+            results[str(n)] = pool.apply(
+                bench_size, (n, args.rows, args.columns, args.svg_pages))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print("Compared to baseline")
+        failures += compare(results, baseline, args.tolerance)
+    if failures:
+        print("Regressions:")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+Offline stand-in for the BGG XML API, to check the fetcher and --serve without the
+network.
+
+It answers /xmlapi2/thing and /xmlapi2/collection with the synthetic games of the
+benchmark: game i is always the same, and a user's collection is games 1 to
+--collection-size. --delay, --throttle-every and --missing make it slow, rate limited
+(429 with Retry-After) or unaware of some games, like BGG on a bad day.
+
+    $ python scripts/fake_bgg.py --port 8036 --collection-size 200
+    $ ./bgg-labeler.py --serve --bgg-api http://127.0.0.1:8036/xmlapi2
+    $ curl -d '{"username": "anyone"}' http://127.0.0.1:8035/labels > labels.pdf
+"""
+import time
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from xml.sax.saxutils import quoteattr
+
+from benchmark import fake_game_data
+
+def item_xml(game_id):
+    """
+    The <item> BGG returns for a game, with stats and the player count poll.
+    """
+    data = fake_game_data(game_id)
+    stats = data['stats']
+    xml = [f'<item type="boardgame" id="{game_id}">',
+           f'<name type="primary" sortindex="1" value={quoteattr(data["name"])}/>',
+           f'<yearpublished value="{data["yearpublished"]}"/>']
+    for key in ('minplayers', 'maxplayers', 'playingtime', 'minplaytime', 'maxplaytime'):
+        xml.append(f'<{key} value="{data[key]}"/>')
+    for category in data['categories']:
+        xml.append(f'<link type="boardgamecategory" id="1" value={quoteattr(category)}/>')
+    xml.append('<poll name="suggested_numplayers" title="User Suggested Number of Players" '
+               'totalvotes="10">')
+    for players, votes in data['suggested_players']['results'].items():
+        xml.append(f'<results numplayers="{players}">'
+                   f'<result value="Best" numvotes="{votes["best_rating"]}"/>'
+                   f'<result value="Recommended" numvotes="{votes["recommended_rating"]}"/>'
+                   f'<result value="Not Recommended" '
+                   f'numvotes="{votes["not_recommended_rating"]}"/></results>')
+    xml.append('</poll><statistics page="1"><ratings><usersrated value="100"/>'
+               f'<average value="{stats["average"]}"/><bayesaverage value="6"/>'
+               f'<averageweight value="{stats["averageweight"]}"/><numweights value="10"/>'
+               '<ranks>')
+    for rank in stats['ranks']:
+        xml.append(f'<rank type="{rank["type"]}" id="{rank["id"]}" name="{rank["name"]}" '
+                   f'friendlyname="{rank["friendlyname"]}" value="{rank["value"]}" '
+                   f'bayesaverage="{rank["bayesaverage"]}"/>')
+    xml.append('</ranks></ratings></statistics></item>')
+    return ''.join(xml)
+
+def collection_item_xml(game_id):
+    return (f'<item objecttype="thing" objectid="{game_id}" subtype="boardgame" '
+            f'collid="{game_id}"><name sortindex="1">Game {game_id}</name>'
+            '<status own="1" prevowned="0" fortrade="0" want="0" wanttoplay="0" '
+            'wanttobuy="0" wishlist="0" preordered="0" lastmodified="2023-01-01 00:00:00"/>'
+            '<numplays>0</numplays></item>')
+
+class FakeBGGServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, collection_size=100, delay=0.0, throttle_every=0,
+                 missing=()):
+        super().__init__(address, FakeBGGHandler)
+        self.collection_size = collection_size
+        self.delay = delay
+        self.throttle_every = throttle_every
+        self.missing = set(missing)
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/xmlapi2'
+
+class FakeBGGHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            throttled = server.throttle_every and server.requests % server.throttle_every == 0
+        if throttled:
+            self.send_response(429)
+            self.send_header('Retry-After', '1')
+            self.end_headers()
+            return
+        time.sleep(server.delay)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/xmlapi2/thing' and 'id' in query:
+            game_ids = [int(game_id) for game_id in query['id'][0].split(',')]
+            items = ''.join(item_xml(game_id) for game_id in game_ids
+                            if game_id not in server.missing)
+            body = f'<items termsofuse="https://boardgamegeek.com/xmlapi/termsofuse">{items}</items>'
+        elif url.path == '/xmlapi2/collection':
+            items = ''.join(collection_item_xml(game_id)
+                            for game_id in range(1, server.collection_size + 1))
+            body = f'<items totalitems="{server.collection_size}">{items}</items>'
+        else:
+            self.send_error(404)
+            return
+        body = ('<?xml version="1.0" encoding="utf-8"?>' + body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start(port=0, **kwargs):
+    """
+    Starts a FakeBGGServer on a background thread. Its url is the api_endpoint to give
+    a FetchScheduler.
+    """
+    server = FakeBGGServer(('127.0.0.1', port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve synthetic games as the BGG XML API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8036)
+    parser.add_argument('--collection-size', type=int, default=100,
+                        help="Games in every user's collection")
+    parser.add_argument('--delay', type=float, default=0.0, metavar='SECONDS',
+                        help="Wait before answering each request")
+    parser.add_argument('--throttle-every', type=int, default=0, metavar='N',
+                        help="Answer every Nth request with 429 Too Many Requests")
+    parser.add_argument('--missing', type=int, nargs='+', default=[], metavar='ID',
+                        help="Games BGG does not know about")
+    args = parser.parse_args()
+
+    server = FakeBGGServer((args.host, args.port), args.collection_size, args.delay,
+                           args.throttle_every, args.missing)
+    print(f"Serving a fake BGG XML API on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
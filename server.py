@@ -0,0 +1,227 @@
+"""
+Long-running label server.
+
+Every CLI run pays again for the interpreter, the template, the fonts and the caches.
+The server sets them up once and answers on a local HTTP API:
+
+    POST /labels {"ids": [13, 822]}                  -> PDF
+    POST /labels {"username": "...", "rows": 6, "cols": 3}
+    POST /labels {"ids": [13], "format": "svg"}      -> SVG
+    GET  /                                           -> status (JSON)
+
+Games asked for by concurrent requests are fetched together: ids arriving within
+`window` seconds of each other go into the same BGG requests, and an id that is
+already being fetched is not asked for again.
+"""
+import json
+import time
+import collections
+import logging
+import threading
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import bgg_labeler as bl
+from fetcher import FetchScheduler, TokenBucket, BGG_API
+
+LOGGER = logging.getLogger('main')
+
+class GameBatcher:
+    """
+    Collects the game ids wanted by concurrent callers of games() and fetches them in
+    batches with fetch(ids), a function yielding the games it found. Games that the
+    batch does not yield are left out of games().
+    """
+    def __init__(self, fetch, window=0.01):
+        self.fetch = fetch
+        self.window = window
+        self.lock = threading.Lock()
+        # game id -> Future, for games asked for and not fetched yet
+        self.pending = {}
+        self.queue = []
+        self.wakeup = threading.Event()
+        self.requested = 0
+        self.batches = 0
+        threading.Thread(target=self.loop, daemon=True).start()
+
+    def games(self, game_ids, timeout=None):
+        futures = []
+        with self.lock:
+            for game_id in game_ids:
+                self.requested += 1
+                future = self.pending.get(game_id)
+                if future is None:
+                    future = self.pending[game_id] = Future()
+                    self.queue.append(game_id)
+                futures.append(future)
+            self.wakeup.set()
+        games = (future.result(timeout) for future in futures)
+        return [game for game in games if game is not None]
+
+    def loop(self):
+        while True:
+            self.wakeup.wait()
+            time.sleep(self.window)
+            with self.lock:
+                game_ids, self.queue = self.queue, []
+                self.wakeup.clear()
+            if game_ids:
+                # a long batch (a whole collection) does not hold up the next ones
+                threading.Thread(target=self.fetch_batch, args=(game_ids,), daemon=True).start()
+
+    def fetch_batch(self, game_ids):
+        self.batches += 1
+        LOGGER.debug(f"Fetching a batch of {len(game_ids)} games")
+        try:
+            for game in self.fetch(game_ids):
+                self.resolve(game.id, result=game)
+            error = None
+        except Exception as e:
+            error = e
+        # the fetch warned about the games BGG did not return
+        for game_id in game_ids:
+            self.resolve(game_id, error=error)
+
+    def resolve(self, game_id, result=None, error=None):
+        with self.lock:
+            future = self.pending.pop(game_id, None)
+        if future is None:
+            return
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+class LabelServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, api_endpoint=BGG_API, requests_per_second=0.5,
+                 max_requests=4, chunk_size=20, collection_ttl=bl.COLLECTION_TTL,
+                 window=0.01):
+        super().__init__(address, LabelHandler)
+        self.api_endpoint = api_endpoint
+        self.chunk_size = chunk_size
+        self.max_requests = max_requests
+        self.collection_ttl = collection_ttl
+        # one budget of BGG requests for all batches
+        self.bucket = TokenBucket(requests_per_second)
+        self.batcher = GameBatcher(self.fetch, window)
+        self.drawings = bl.DrawingCache()
+        # drawing changes the cached drawings, requests take turns at it
+        self.draw_lock = threading.Lock()
+        self.collections = {}
+        # one lock per username: a collection is fetched once however many requests
+        # want it, without holding up the requests for other collections
+        self.collection_locks = collections.defaultdict(threading.Lock)
+        self.collection_lock = threading.Lock()
+        self.served = 0
+
+    def scheduler(self):
+        return FetchScheduler(bl.context.session, self.api_endpoint,
+                              chunk_size=self.chunk_size,
+                              max_in_flight=self.max_requests,
+                              cache=bl.context.game_cache,
+                              bucket=self.bucket)
+
+    def fetch(self, game_ids):
+        scheduler = self.scheduler()
+        yield from scheduler.games(game_ids)
+        scheduler.revalidate()
+        bl.context.game_cache.flush()
+
+    def collection(self, username):
+        """
+        The game ids of username's collection, kept for collection_ttl seconds.
+        """
+        with self.collection_lock:
+            lock = self.collection_locks[username]
+        with lock:
+            fetched, game_ids = self.collections.get(username, (0, None))
+            if time.time() - fetched > self.collection_ttl:
+                game_ids = [game_id for game_id, _ in self.scheduler().collection(username)]
+                self.collections[username] = (time.time(), game_ids)
+            return game_ids
+
+    def warm_up(self):
+        """
+        Sets up everything a label needs, so that the first request is as fast as the next.
+        """
+        bl.compile_template(bl.SVG_TEMPLATE)
+        bl.template_digest(bl.SVG_TEMPLATE)
+        bl.register_fonts()
+        bl.context.layout
+        bl.context.game_cache
+        bl.context.session
+
+    def render(self, request):
+        if 'ids' in request:
+            game_ids = [int(game_id) for game_id in request['ids']]
+        elif 'username' in request:
+            game_ids = self.collection(request['username'])
+        else:
+            raise ValueError("Expected 'ids' or 'username'")
+        rows = int(request.get('rows', 6))
+        cols = int(request.get('cols', 3))
+        if rows < 1 or cols < 1:
+            raise ValueError("Expected at least one row and one column")
+        labels = [bl.render_label(game) for game in self.batcher.games(game_ids)]
+        if not labels:
+            raise ValueError("No games to print")
+        self.served += len(labels)
+        if request.get('format', 'pdf') == 'svg':
+            return 'image/svg+xml', bl.sheet_svg(labels, cols)
+        with self.draw_lock:
+            pdf, _ = bl.draw_pages(bl.paginate(labels, rows, cols), cols,
+                                   drawing_cache=self.drawings)
+        return 'application/pdf', pdf
+
+    def status(self):
+        return {'labels_served': self.served,
+                'games_requested': self.batcher.requested,
+                'batches': self.batcher.batches,
+                'game_cache': bl.context.game_cache.stats()}
+
+class LabelHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        LOGGER.debug(f"{self.address_string()} {format % args}")
+
+    def reply(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply_json(self, status, data):
+        self.reply(status, 'application/json', json.dumps(data).encode())
+
+    def do_GET(self):
+        if self.path != '/':
+            return self.reply_json(404, {'error': f"No {self.path}"})
+        self.reply_json(200, self.server.status())
+
+    def do_POST(self):
+        if self.path != '/labels':
+            return self.reply_json(404, {'error': f"No {self.path}"})
+        start = time.perf_counter()
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+            content_type, body = self.server.render(request)
+        except (ValueError, TypeError) as e:
+            return self.reply_json(400, {'error': str(e)})
+        except Exception as e:
+            LOGGER.exception("Could not render labels")
+            return self.reply_json(500, {'error': str(e)})
+        LOGGER.debug(f"Rendered in {(time.perf_counter() - start) * 1000:.0f} ms")
+        self.reply(200, content_type, body)
+
+def serve(host='127.0.0.1', port=8035, **kwargs):
+    server = LabelServer((host, port), **kwargs)
+    server.warm_up()
+    print(f"Serving labels on http://{host}:{server.server_address[1]}/labels", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
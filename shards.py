@@ -0,0 +1,175 @@
+"""
+Sharded runs: one collection printed by several machines (or processes) at once.
+
+The labels of a collection are split in blocks of as many games as fit on a segment of
+the PDF (JOURNAL_SEGMENT_PAGES pages, see draw_segments), and `--shard i/N` only prints
+blocks i, i + N, i + 2N... (counting from 1). Each block is laid out and drawn on its
+own, exactly as a single run draws that segment, and saved with its pages to the shard
+directory. `--merge` then joins the blocks of every shard in order, like draw_segments
+joins segments, so that the PDF is the same, byte for byte, as a single run's.
+
+A block only holds the same labels as the segment of a single run if every game before
+it got a label. When some did not (BGG had nothing for them, or they were quarantined),
+the labels after them move up: merge() draws again the segments that changed, from the
+labels the shards saved.
+"""
+import json
+import hashlib
+import itertools
+from pathlib import Path
+import bgg_labeler as bl
+from journal import atomic_write
+
+SHARD_VERSION = 1
+
+def parse_shard(spec):
+    """
+    Reads a shard spec, "i/N", as (i, N).
+    """
+    try:
+        shard, shards = (int(n) for n in spec.split('/'))
+    except ValueError:
+        raise ValueError(f"Expected a shard as i/N, e.g. 1/4, not {spec!r}")
+    if not 1 <= shard <= shards:
+        raise ValueError(f"Shard {shard}/{shards} does not exist, shards go from 1 to {shards}")
+    return shard, shards
+
+def shard_dir(out_file, shard, shards):
+    """
+    The directory a shard of the run writing out_file writes to.
+    """
+    out_file = Path(out_file)
+    return out_file.with_name(f'{out_file.stem}.shard-{shard}-of-{shards}')
+
+def games_digest(game_ids):
+    return hashlib.sha256(','.join(map(str, game_ids)).encode()).hexdigest()
+
+class Shard:
+    """
+    Shard `shard` of `shards` of a run printing game_ids, saved to directory.
+    """
+    def __init__(self, directory, shard, shards, game_ids, rows, cols, svg_file=bl.SVG_TEMPLATE):
+        self.directory = Path(directory)
+        self.label_dir = self.directory / 'labels'
+        self.rows = rows
+        self.cols = cols
+        self.block_pages = bl.JOURNAL_SEGMENT_PAGES
+        block_size = self.block_pages * rows * cols
+        blocks = range(shard - 1, -(-len(game_ids) // block_size), shards)
+        self.block_of = {game_id: block
+                         for block in blocks
+                         for game_id in game_ids[block * block_size:(block + 1) * block_size]}
+        # the games this shard prints
+        self.game_ids = [game_id for game_id in game_ids if game_id in self.block_of]
+        self.manifest = {'version': SHARD_VERSION,
+                         'shard': shard,
+                         'shards': shards,
+                         'rows': rows,
+                         'cols': cols,
+                         'block_pages': self.block_pages,
+                         'games': games_digest(game_ids),
+                         'count': len(game_ids),
+                         'template': bl.template_digest(svg_file).hex(),
+                         'blocks': {str(block): None for block in blocks}}
+
+    def start(self):
+        self.label_dir.mkdir(parents=True, exist_ok=True)
+        self.save()
+
+    def save(self):
+        atomic_write(self.directory / 'shard.json', json.dumps(self.manifest))
+
+    def draw(self, labels):
+        """
+        Draws (game id, (key, svg)) labels, in order, block by block. Returns the number
+        of pages drawn.
+        """
+        pages = 0
+        blocks = self.manifest['blocks']
+        for block, block_labels in itertools.groupby(labels,
+                                                     key=lambda label: self.block_of[label[0]]):
+            pdf, keys = bl.draw_pages(bl.paginate((label for _, label in block_labels),
+                                                  self.rows, self.cols), self.cols)
+            atomic_write(self.directory / f'block-{block:05d}.pdf', pdf)
+            blocks[str(block)] = keys
+            self.save()
+            pages += len(keys)
+        # blocks none of whose games got a label are empty
+        for block, keys in blocks.items():
+            if keys is None:
+                blocks[block] = []
+        self.save()
+        return pages
+
+class ShardSet:
+    """
+    The blocks drawn by every shard of a run, read from their directories. Has the
+    segment() and save_segment() of a RunJournal, for draw_segments.
+    """
+    def __init__(self, directories):
+        self.directories = [Path(directory) for directory in directories]
+        manifests = []
+        for directory in self.directories:
+            try:
+                with open(directory / 'shard.json') as f:
+                    manifests.append(json.load(f))
+            except FileNotFoundError:
+                raise ValueError(f"{directory} is not the directory of a --shard run") from None
+        first = manifests[0]
+        for manifest in manifests:
+            if manifest.get('version') != SHARD_VERSION:
+                raise ValueError(f"Shard {manifest.get('shard')} was written by another "
+                                 "version of the labeler")
+            for key in ('shards', 'rows', 'cols', 'block_pages', 'games', 'template'):
+                if manifest[key] != first[key]:
+                    raise ValueError(f"Shards {first['shard']} and {manifest['shard']} are "
+                                     f"not of the same run (different {key})")
+        shards = sorted(manifest['shard'] for manifest in manifests)
+        if shards != list(range(1, first['shards'] + 1)):
+            raise ValueError(f"Expected shards 1 to {first['shards']} once each, "
+                             f"got {', '.join(map(str, shards))}")
+        self.rows = first['rows']
+        self.cols = first['cols']
+        self.block_pages = first['block_pages']
+        self.blocks = {}
+        self.block_dirs = {}
+        for directory, manifest in zip(self.directories, manifests):
+            for block, keys in manifest['blocks'].items():
+                if keys is None:
+                    raise ValueError(f"Shard {manifest['shard']} did not finish")
+                self.blocks[int(block)] = keys
+                self.block_dirs[int(block)] = directory
+        self.blocks = [self.blocks[block] for block in sorted(self.blocks)]
+
+    def labels(self):
+        """
+        Yields the (key, svg file) labels of every block, in order.
+        """
+        files = {}
+        for directory in self.directories:
+            for path in (directory / 'labels').glob('*.svg'):
+                files.setdefault(path.stem, path)
+        for keys in self.blocks:
+            for page in keys:
+                for key in page:
+                    yield key, files[key]
+
+    def segment(self, n, cols, pages):
+        if n >= len(self.blocks) or cols != self.cols or self.blocks[n] != pages:
+            return None
+        with open(self.block_dirs[n] / f'block-{n:05d}.pdf', 'rb') as f:
+            return f.read()
+
+    def save_segment(self, n, cols, pages, pdf):
+        pass
+
+def merge(directories, out_file):
+    """
+    Writes to out_file the PDF of the run whose shards wrote to directories. Returns
+    the number of pages.
+    """
+    shards = ShardSet(directories)
+    pages = bl.paginate(shards.labels(), shards.rows, shards.cols)
+    pdf, keys = bl.draw_segments(pages, shards.cols, shards, segment_pages=shards.block_pages)
+    atomic_write(out_file, pdf)
+    return len(keys)
@@ -0,0 +1,188 @@
+"""
+Local snapshot of collections and game data.
+
+Unlike the HTTP cache of the BGG client, which expires after an hour, the snapshot
+keeps the last known data of every game indefinitely, one row per game and only the
+fields label records are built from, so that labels can be printed again offline and
+reproducibly. It also keeps each user's collection as of their last sync, which --sync compares
+against to print labels only for the games that changed since.
+"""
+import json
+import sqlite3
+import time
+
+# keys of BoardGame.data() that label records are built from
+GAME_FIELDS = ('id', 'name', 'yearpublished', 'minplayers', 'maxplayers',
+               'minplaytime', 'maxplaytime', 'playingtime', 'categories')
+STATS_FIELDS = ('average', 'averageweight', 'ranks')
+
+def game_record(game):
+    """
+    Returns the part of a BoardGame's data needed to build its LabelRecord.
+    """
+    data = game.data()
+    record = {key: data.get(key) for key in GAME_FIELDS}
+    record['stats'] = {key: data['stats'].get(key) for key in STATS_FIELDS}
+    record['suggested_players'] = {
+        'results': data.get('suggested_players', {}).get('results', {})}
+    return record
+
+def collection_delta(previous, current):
+    """
+    Compares two collections given as (game id, last_modified) pairs and returns the
+    ids that were added, removed and modified, in collection order.
+    """
+    previous = dict(previous)
+    current = dict(current)
+    added = [game_id for game_id in current if game_id not in previous]
+    removed = [game_id for game_id in previous if game_id not in current]
+    modified = [game_id for game_id, last_modified in current.items()
+                if game_id in previous and previous[game_id] != last_modified]
+    return added, removed, modified
+
+class StoredGame:
+    """
+    The stored data of a game, with the id, name and data() of a BoardGame: enough to
+    build its LabelRecord, without building the BoardGame.
+    """
+    __slots__ = ('id', 'name', 'stored')
+
+    def __init__(self, data):
+        self.id = data.get('id')
+        self.name = data.get('name')
+        self.stored = data
+
+    def data(self):
+        return self.stored
+
+class SnapshotStore:
+    def __init__(self, path):
+        self.db = sqlite3.connect(str(path))
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS games (
+                id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL,
+                updated REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS collections (
+                username TEXT NOT NULL,
+                game_id INTEGER NOT NULL,
+                last_modified TEXT,
+                PRIMARY KEY (username, game_id));
+            CREATE TABLE IF NOT EXISTS synced (
+                username TEXT NOT NULL,
+                game_id INTEGER NOT NULL,
+                last_modified TEXT,
+                PRIMARY KEY (username, game_id));
+        ''')
+
+    def close(self):
+        self.db.close()
+
+    def save_games(self, records):
+        now = time.time()
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO games (id, data, updated) VALUES (?, ?, ?)',
+                ((record['id'], json.dumps(record), now) for record in records))
+
+    def record(self, games, batch=100):
+        """
+        Yields games unchanged, saving them to the snapshot along the way, including
+        when it is closed before the end.
+        """
+        records = []
+        try:
+            for game in games:
+                records.append(game_record(game))
+                if len(records) >= batch:
+                    self.save_games(records)
+                    records = []
+                yield game
+        finally:
+            self.save_games(records)
+
+    def save_collection(self, username, items):
+        """
+        Replaces the stored collection of username with items, a list of
+        (game id, last_modified) pairs.
+        """
+        with self.db:
+            self.db.execute('DELETE FROM collections WHERE username = ?', (username,))
+            self.db.executemany(
+                'INSERT OR REPLACE INTO collections VALUES (?, ?, ?)',
+                ((username, game_id, last_modified) for game_id, last_modified in items))
+
+    def collection(self, username):
+        """
+        Returns the stored collection of username as (game id, last_modified) pairs.
+        """
+        return self.db.execute(
+            'SELECT game_id, last_modified FROM collections WHERE username = ? '
+            'ORDER BY rowid', (username,)).fetchall()
+
+    def synced_collection(self, username):
+        """
+        Returns the collection of username as of the last completed sync.
+        """
+        return self.db.execute(
+            'SELECT game_id, last_modified FROM synced WHERE username = ? '
+            'ORDER BY rowid', (username,)).fetchall()
+
+    def save_synced_collection(self, username, items):
+        with self.db:
+            self.db.execute('DELETE FROM synced WHERE username = ?', (username,))
+            self.db.executemany(
+                'INSERT OR REPLACE INTO synced VALUES (?, ?, ?)',
+                ((username, game_id, last_modified) for game_id, last_modified in items))
+
+    def stored_games(self, game_ids, batch=500):
+        """
+        Yields the stored data of game_ids as StoredGames, in order, read batch games
+        at a time. Raises KeyError, before yielding any, for games that are not in the
+        snapshot.
+        """
+        for n in range(0, len(game_ids), batch):
+            ids = game_ids[n:n + batch]
+            found = {row[0] for row in self.db.execute(
+                f'SELECT id FROM games WHERE id IN ({",".join("?" * len(ids))})', ids)}
+            for game_id in ids:
+                if game_id not in found:
+                    raise KeyError(f"Game {game_id} is not in the snapshot, run once online first")
+        for n in range(0, len(game_ids), batch):
+            ids = game_ids[n:n + batch]
+            data = dict(self.db.execute(
+                f'SELECT id, data FROM games WHERE id IN ({",".join("?" * len(ids))})', ids))
+            for game_id in ids:
+                yield StoredGame(json.loads(data[game_id]))
+
+    def export(self, file):
+        """
+        Writes the whole snapshot as JSON lines to file.
+        """
+        with open(file, 'w') as f:
+            for (data,) in self.db.execute('SELECT data FROM games ORDER BY id'):
+                f.write(f'{{"game": {data}}}\n')
+            for username, game_id, last_modified in self.db.execute(
+                    'SELECT * FROM collections ORDER BY username, rowid'):
+                f.write(json.dumps({'collection': username, 'id': game_id,
+                                    'last_modified': last_modified}) + '\n')
+
+    def import_(self, file):
+        """
+        Adds the games and collections of a file written by export() to the snapshot.
+        Collections in the file replace the stored ones of the same users.
+        """
+        records = []
+        collections = {}
+        with open(file) as f:
+            for line in f:
+                entry = json.loads(line)
+                if 'game' in entry:
+                    records.append(entry['game'])
+                else:
+                    collections.setdefault(entry['collection'], []).append(
+                        (entry['id'], entry['last_modified']))
+        self.save_games(records)
+        for username, items in collections.items():
+            self.save_collection(username, items)
+        return len(records), len(collections)
@@ -0,0 +1,189 @@
+"""
+Per-stage timing of a run.
+
+Stages are either blocks (Tracer.stage) or iterators (Tracer.iterate), which lets the
+streaming pipeline be timed even though its stages advance together: each stage is
+charged only for the time spent in it, not in the stages it pulls from. Every block
+and every item becomes a complete event of a Chrome trace (chrome://tracing, Perfetto).
+
+CPU time is counted for this process and, separately, for the worker processes that
+ended during the stage (the OS only reports the usage of children once they have been
+waited for). Memory is a high-water mark, so stages report how much they raised the
+peak of this process, next to the peaks so far of this process and of its workers.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import cProfile
+import threading
+from contextlib import contextmanager
+
+LOGGER = logging.getLogger('main')
+
+def peak_rss_mb(who='RUSAGE_SELF'):
+    """
+    The high-water mark of this process (or with who='RUSAGE_CHILDREN', of the largest
+    of its children that ended), or None where the resource module is missing.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(getattr(resource, who)).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+def workers_cpu_time():
+    """
+    CPU time of the children of this process that ended (0 on Windows).
+    """
+    times = os.times()
+    return times.children_user + times.children_system
+
+class Stage:
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.wall = 0
+        self.cpu = 0
+        self.workers_cpu = 0
+        self.child_wall = 0
+        self.child_cpu = 0
+        self.child_workers_cpu = 0
+        self.rss_growth = None
+        self.child_rss_growth = 0
+        self.process_peak_rss = None
+        self.workers_peak_rss = None
+
+    def summary(self):
+        wall = self.wall - self.child_wall
+        growth = self.rss_growth
+        if growth is not None:
+            growth -= self.child_rss_growth
+        return {'items': self.items,
+                'wall_seconds': round(wall, 4),
+                'cpu_seconds': round(self.cpu - self.child_cpu, 4),
+                'workers_cpu_seconds': round(self.workers_cpu - self.child_workers_cpu, 4),
+                'per_second': round(self.items / wall, 2) if wall > 0 else None,
+                'peak_rss_growth_mb': rounded(growth),
+                'process_peak_rss_mb': rounded(self.process_peak_rss),
+                'workers_peak_rss_mb': rounded(self.workers_peak_rss)}
+
+def rounded(mb):
+    return None if mb is None else round(mb, 1)
+
+class Tracer:
+    """
+    Collects stage timings. If profile_stage is given, that stage (and only that
+    stage, not those it calls into) runs under cProfile.
+    """
+    def __init__(self, profile_stage=None):
+        self.stages = {}
+        self.events = []
+        self.stack = []
+        self.start = time.perf_counter()
+        self.profile_stage = profile_stage
+        self.profiler = cProfile.Profile() if profile_stage else None
+
+    def _profile(self, enable):
+        if self.stack and self.stack[-1][0].name == self.profile_stage:
+            if enable:
+                self.profiler.enable()
+            else:
+                self.profiler.disable()
+
+    def _enter(self, name):
+        self._profile(False)
+        stage = self.stages.setdefault(name, Stage(name))
+        self.stack.append((stage, time.perf_counter(), time.process_time(),
+                           workers_cpu_time(), peak_rss_mb()))
+        self._profile(True)
+        return stage
+
+    def _exit(self, items=0):
+        self._profile(False)
+        stage, wall_start, cpu_start, workers_cpu_start, rss_start = self.stack.pop()
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        workers_cpu = workers_cpu_time() - workers_cpu_start
+        stage.items += items
+        stage.wall += wall
+        stage.cpu += cpu
+        stage.workers_cpu += workers_cpu
+        stage.process_peak_rss = peak_rss_mb()
+        stage.workers_peak_rss = peak_rss_mb('RUSAGE_CHILDREN')
+        rss_growth = 0
+        if rss_start is not None:
+            rss_growth = stage.process_peak_rss - rss_start
+            stage.rss_growth = (stage.rss_growth or 0) + rss_growth
+        if self.stack:
+            parent = self.stack[-1][0]
+            parent.child_wall += wall
+            parent.child_cpu += cpu
+            parent.child_workers_cpu += workers_cpu
+            parent.child_rss_growth += rss_growth
+        self.events.append({'name': stage.name,
+                            'ph': 'X',
+                            'ts': round((wall_start - self.start) * 1e6, 1),
+                            'dur': round(wall * 1e6, 1),
+                            'pid': os.getpid(),
+                            'tid': threading.get_ident(),
+                            'args': {'items': items}})
+        self._profile(True)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times a block. The Stage is yielded so that the block can add to its items.
+        """
+        stage = self._enter(name)
+        items = stage.items
+        try:
+            yield stage
+        finally:
+            added = stage.items - items
+            stage.items = items
+            self._exit(added)
+
+    def iterate(self, name, iterable):
+        """
+        Yields from iterable, timing the production of each item as stage `name`.
+        """
+        iterator = iter(iterable)
+        while True:
+            self._enter(name)
+            produced = 0
+            try:
+                item = next(iterator)
+                produced = 1
+            except StopIteration:
+                return
+            finally:
+                self._exit(produced)
+            yield item
+
+    def summary(self):
+        return {name: stage.summary() for name, stage in self.stages.items()}
+
+    def log_summary(self):
+        for name, stage in self.summary().items():
+            rate = f"{stage['per_second']}/s" if stage['per_second'] else '-'
+            LOGGER.info(f"{name:12} {stage['items']:6} items "
+                        f"{stage['wall_seconds']:8.2f}s wall "
+                        f"{stage['cpu_seconds']:8.2f}s cpu "
+                        f"{stage['workers_cpu_seconds']:8.2f}s workers cpu {rate:>12} "
+                        f"peak +{stage['peak_rss_growth_mb'] or 0:.0f} MB "
+                        f"(process {stage['process_peak_rss_mb'] or 0:.0f} MB, "
+                        f"workers {stage['workers_peak_rss_mb'] or 0:.0f} MB)")
+
+    def write(self, trace_file):
+        with open(trace_file, 'w') as f:
+            json.dump({'traceEvents': self.events,
+                       'displayTimeUnit': 'ms',
+                       'otherData': {'stages': self.summary()}}, f)
+
+    def dump_profile(self, profile_file=None):
+        if self.profiler:
+            self.profiler.dump_stats(profile_file or f'{self.profile_stage}.prof')